@@ -0,0 +1,279 @@
+import functools
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import traceback
+
+import numpy as np
+from shapely import LineString, Polygon
+
+from caching import COARSE_LEVEL, ROUTE_TOLERANCES, Cache
+from data import Canton
+from data.scrambling import Scrambler
+from routing.brouter import Brouter
+from routing.valhalla import Valhalla, decode, encode
+from routing_service import DEST_COORDS, great_circle_distance
+from such_route import read_checkpoints
+
+from .server import StubRoutingServer, load_recorded_routes, synthetic_route
+
+CHECKPOINTS = 'checkpoints.csv'
+# radius of the synthetic cantons around every checkpoint in degrees
+CANTON_RADIUS = 0.15
+# number of vertices of a synthetic canton, about the size of the border of a real canton
+CANTON_VERTICES = 5000
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def synthetic_cantons(checkpoints, cache):
+    """
+    Create a canton with a jagged border around every checkpoint, so no Overpass request is necessary.
+    """
+    angles = np.linspace(0, 2 * np.pi, CANTON_VERTICES, endpoint=False)
+    # large bays and a fine detail of about 20m like a border along a river
+    radii = CANTON_RADIUS * (1 + 0.1 * np.sin(40 * angles)) + np.random.default_rng(0).normal(0, 0.0002, len(angles))
+    for checkpoint in checkpoints:
+        if not cache.get_generic(checkpoint['code']):
+            cache.set_generic(checkpoint['code'], Polygon(np.column_stack(
+                (checkpoint['longitude'] + radii * np.cos(angles), checkpoint['latitude'] + radii * np.sin(angles)))))
+    return {checkpoint['code']: Canton(checkpoint['code'], cache) for checkpoint in checkpoints}
+
+
+def synthetic_matrix(coordinates):
+    """
+    Distance matrix of the great-circle travel time with 5 m/s.
+    """
+    return {source: {target: int(great_circle_distance(source, target) / 5)
+                     for target in coordinates if target != source} for source in coordinates}
+
+
+def _bench_matrix(routing_backend, directory, options):
+    checkpoints = read_checkpoints(CHECKPOINTS)
+    # the size is the number of checkpoints of the matrix, including the final destination
+    coordinates = [(checkpoint['longitude'], checkpoint['latitude']) for checkpoint in checkpoints
+                   if (checkpoint['longitude'], checkpoint['latitude']) != DEST_COORDS][:max(options['size'] - 1, 1)]
+    coordinates.append(DEST_COORDS)
+    routes = load_recorded_routes() if options['recorded'] else None
+    with StubRoutingServer(routes, latency=options['latency']) as server:
+        cache = Cache(os.path.join(directory, 'cache'), routing_backend.__name__.lower())
+        cache.load()
+        routing_backend(cache, url=server.url).matrix(coordinates)
+        return server.requests
+
+
+def bench_matrix(directory, options):
+    return _bench_matrix(Valhalla, directory, options)
+
+
+def bench_brouter_matrix(directory, options):
+    return _bench_matrix(Brouter, directory, options)
+
+
+def bench_cache(directory, options):
+    cache = Cache(os.path.join(directory, 'cache'), 'valhalla')
+    cache.load()
+    entries = options['size'] * 1000
+    for i in range(entries):
+        cache.set((i, i / 10), (7 + i * 1e-6, 46.5), (8.5, 47 - i * 1e-6))
+    cache.save()
+    Cache(os.path.join(directory, 'cache'), 'valhalla').load()
+    # every entry is saved and loaded once
+    return 2 * entries
+
+
+def bench_decode(directory, options):
+    encoded = encode(synthetic_route((6.1, 46.2), (9.5, 47.6), points=5000))
+    rounds = options['size']
+    for _ in range(rounds):
+        decode(encoded)
+    # number of decoded points
+    return rounds * 5000
+
+
+def winding_route(source, target, random, points=1000):
+    """
+    Create a route, which meanders around the direct line like a road, unlike the routes of the stub server.
+    :param random: numpy random generator
+    :return: array of (lon, lat)
+    """
+    source, target = np.array(source), np.array(target)
+    direction = target - source
+    normal = np.array((-direction[1], direction[0])) / np.hypot(*direction)
+    fractions = np.linspace(0, 1, points)
+    offsets = np.cumsum(random.normal(0, 0.0015, points))
+    # the route starts and ends at the given points
+    offsets -= offsets[0] + fractions * (offsets[-1] - offsets[0])
+    return source + np.outer(fractions, direction) + np.outer(offsets, normal)
+
+
+def _intersection_lines(checkpoints):
+    random = np.random.default_rng(0)
+    routes = load_recorded_routes() + [
+        winding_route((a['longitude'], a['latitude']), (b['longitude'], b['latitude']), random)
+        for a, b in zip(checkpoints, checkpoints[1:])]
+    return [LineString(route) for route in routes]
+
+
+def _cached_intersection_routes(cache, checkpoints):
+    """
+    Store the routes in the cache with their levels of detail, like the routing service.
+    :return: list of the route keys
+    """
+    cache.load()
+    route_keys = []
+    for i, line in enumerate(_intersection_lines(checkpoints)):
+        route_key = f'route-{i}'
+        cache.set_route_file(route_key, line)
+        route_keys.append(route_key)
+    return route_keys
+
+
+def bench_intersection(directory, options):
+    cache = Cache(os.path.join(directory, 'cache'), 'valhalla')
+    checkpoints = read_checkpoints(CHECKPOINTS)
+    cantons = synthetic_cantons(checkpoints, cache)
+    route_keys = _cached_intersection_routes(cache, checkpoints)
+    start = time.perf_counter()
+    intersections = 0
+    for _ in range(options['size']):
+        for route_key in route_keys:
+            line = cache.get_route_file(route_key)
+            for canton in cantons.values():
+                canton.intersect(line)
+                intersections += 1
+    return intersections, time.perf_counter() - start
+
+
+def bench_coarse_intersection(directory, options):
+    cache = Cache(os.path.join(directory, 'cache'), 'valhalla')
+    checkpoints = read_checkpoints(CHECKPOINTS)
+    cantons = synthetic_cantons(checkpoints, cache)
+    route_keys = _cached_intersection_routes(cache, checkpoints)
+    tolerance = ROUTE_TOLERANCES[COARSE_LEVEL]
+    # the buffers of the cantons are created in the first round
+    start = time.perf_counter()
+    intersections = 0
+    for _ in range(options['size']):
+        for route_key in route_keys:
+            # like GroupTspSolver, the full route is only loaded near a border
+            coarse = cache.get_route_file(route_key, COARSE_LEVEL)
+            full_route = functools.cache(lambda: cache.get_route_file(route_key))
+            for canton in cantons.values():
+                canton.intersect(coarse, tolerance, full_route)
+                intersections += 1
+    return intersections, time.perf_counter() - start
+
+
+def bench_variants(directory, options):
+    cache = Cache(os.path.join(directory, 'cache'), 'valhalla')
+    checkpoints = read_checkpoints(CHECKPOINTS)
+    cantons = synthetic_cantons(checkpoints, cache)
+    variants = 0
+    for _ in range(options['size']):
+        variants += len(Scrambler(checkpoints, cantons).calc_matrices())
+    return variants
+
+
+def bench_tsp(directory, options):
+    try:
+        # the solver only imports gurobipy when it solves
+        import gurobipy  # noqa: F401
+        import pandas as pd
+        from tsp_solver import CheckpointIndex, TspSolver
+    except ImportError:
+        return None
+
+    class SyntheticStation:
+        def __init__(self, cost):
+            self._cost = cost
+
+        def get_cost(self):
+            return self._cost
+
+    data = pd.read_csv(CHECKPOINTS, sep=';', encoding='utf-8')
+    stations = {(row['Latitude'], row['Longitude']): SyntheticStation(600) for _, row in data.iterrows()}
+    index = CheckpointIndex(data, stations)
+    cache = Cache(os.path.join(directory, 'cache'), 'valhalla')
+    checkpoints = read_checkpoints(CHECKPOINTS)
+    variants = Scrambler(checkpoints, synthetic_cantons(checkpoints, cache)).calc_matrices()[:options['size']]
+    for coordinates, _ in variants:
+        imported_distance = synthetic_matrix(coordinates)
+        reduced_data = data[data.index.isin([index.rows[coordinates] for coordinates in imported_distance])].copy()
+        TspSolver(cache, stations, reduced_data, imported_distance, index=index).solve()
+    return len(variants)
+
+
+# benchmarks by name: function of the temporary directory and the options returning the number of operations, or a
+# tuple of the operations and the seconds of the hot path without the setup, None if the benchmark is skipped
+BENCHMARKS = {
+    'matrix': bench_matrix,
+    'brouter_matrix': bench_brouter_matrix,
+    'cache': bench_cache,
+    'decode': bench_decode,
+    'intersection': bench_intersection,
+    'coarse_intersection': bench_coarse_intersection,
+    'variants': bench_variants,
+    'tsp': bench_tsp,
+}
+
+
+def _run_isolated(name, options, connection):
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            ops = BENCHMARKS[name](directory, options)
+            seconds = time.perf_counter() - start
+        if isinstance(ops, tuple):
+            # the benchmark measured its hot path without the setup
+            ops, seconds = ops
+        connection.send((ops, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    except Exception:
+        # the exception itself is not necessarily picklable, its traceback is
+        connection.send(BenchmarkError(f'benchmark {name} failed:\n{traceback.format_exc()}'))
+    finally:
+        connection.close()
+
+
+def run(name, options):
+    """
+    Run a benchmark in a fresh process, so the peak RSS only belongs to this benchmark.
+    :param name: name of the benchmark
+    :param options: dict with latency, recorded and size
+    :return: dict with ops, seconds, ops_per_second and peak_rss_kb or None, if the benchmark was skipped
+    :raises BenchmarkError: if the benchmark failed
+    """
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_isolated, args=(name, options, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        process.join()
+        raise BenchmarkError(f'benchmark {name} exited with code {process.exitcode} without a result')
+    process.join()
+    if isinstance(result, BenchmarkError):
+        raise result
+    ops, seconds, peak_rss = result
+    if ops is None:
+        return None
+    return {'ops': ops, 'seconds': seconds, 'ops_per_second': ops / seconds, 'peak_rss_kb': peak_rss}
+
+
+def compare(results, baseline):
+    """
+    Compare the results with a baseline.
+    :return: dict of the name of the benchmark to the tuple of (throughput ratio, peak RSS ratio)
+    """
+    comparison = {}
+    for name, result in results.items():
+        if result and baseline.get(name):
+            comparison[name] = (result['ops_per_second'] / baseline[name]['ops_per_second'],
+                                result['peak_rss_kb'] / baseline[name]['peak_rss_kb'])
+    return comparison
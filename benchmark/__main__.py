@@ -0,0 +1,48 @@
+import argparse
+import json
+
+from benchmark import BENCHMARKS, compare, run
+
+if __name__ == '__main__':
+    '''
+    This script measures the throughput and peak memory of the hot paths against a local stub routing server
+    '''
+    parser = argparse.ArgumentParser(description='Benchmarks the SUCH route pipeline')
+
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f'The benchmarks to run, all if omitted: {", ".join(BENCHMARKS)}')
+    parser.add_argument('-l', '--latency', type=float, default=0.005,
+                        help='Latency of the stub routing server in seconds')
+    parser.add_argument('-r', '--recorded', action='store_true',
+                        help='Replay the recorded routes of test/*.geojson instead of synthetic ones')
+    parser.add_argument('-s', '--size', type=int, default=10,
+                        help='Number of rounds of every benchmark, the number of checkpoints of the matrix '
+                             'benchmarks')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Write the results to the given JSON file, e.g. to use them as baseline')
+    parser.add_argument('-c', '--compare', type=str, default=None,
+                        help='Compare the results to the baseline in the given JSON file')
+
+    args = parser.parse_args()
+    if unknown := set(args.benchmarks) - set(BENCHMARKS):
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+    options = {'latency': args.latency, 'recorded': args.recorded, 'size': args.size}
+
+    results = {}
+    for name in args.benchmarks or list(BENCHMARKS):
+        results[name] = run(name, options)
+        if results[name] is None:
+            print(f'{name:<20} skipped')
+            continue
+        print(f'{name:<20} {results[name]["ops_per_second"]:>14.1f} ops/s '
+              f'{results[name]["seconds"]:>8.2f}s {results[name]["peak_rss_kb"] / 1024:>8.1f} MiB peak RSS')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        for name, (throughput, memory) in compare(results, baseline).items():
+            print(f'{name:<20} throughput x{throughput:.2f}, peak RSS x{memory:.2f} compared to baseline')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,146 @@
+import glob
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import geojson
+
+from routing.valhalla import encode
+from routing_service import great_circle_distance
+
+# average speed of the synthetic routes in m/s
+SPEED = 5
+# number of points of a synthetic route
+SYNTHETIC_POINTS = 200
+
+
+def load_recorded_routes(pattern='test/*.geojson'):
+    """
+    Load the route geometries of recorded BRouter responses.
+    :param pattern: glob pattern of the geojson files
+    :return: list of coordinate lists of (lon, lat)
+    """
+    routes = []
+    for filename in sorted(glob.glob(pattern)):
+        with open(filename, encoding='utf-8') as f:
+            geojson_data = geojson.load(f)
+        coordinates = geojson_data['features'][0]['geometry']['coordinates']
+        routes.append([(lon, lat) for lon, lat, *_ in coordinates])
+    return routes
+
+
+def synthetic_route(source, target, points=SYNTHETIC_POINTS):
+    """
+    Create a slightly winding route between source and target.
+    :param source: source coordinates: tuple of (lon, lat)
+    :param target: target coordinates: tuple of (lon, lat)
+    :param points: number of points of the route
+    :return: list of (lon, lat)
+    """
+    route = []
+    for i in range(points):
+        fraction = i / (points - 1)
+        wiggle = 0.001 * (1 if i % 2 else -1) if 0 < i < points - 1 else 0
+        route.append((source[0] + (target[0] - source[0]) * fraction + wiggle,
+                      source[1] + (target[1] - source[1]) * fraction))
+    return route
+
+
+class StubRoutingServer:
+    """
+    Local HTTP server answering Valhalla /route and BRouter /brouter requests with recorded or synthetic routes.
+    """
+    def __init__(self, routes=None, latency=0.0, host='127.0.0.1', port=0):
+        """
+        :param routes: recorded routes, which are replayed in turn. Synthetic routes are created, if None
+        :param latency: delay of every response in seconds
+        """
+        self._routes = routes
+        self._latency = latency
+        self._next_route = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self.requests = 0
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def route(self, source, target):
+        """
+        Answer a request with the next recorded route or a synthetic one.
+        :return: tuple of (time in seconds, length in meters, list of (lon, lat))
+        """
+        with self._lock:
+            self.requests += 1
+            if self._routes:
+                coordinates = self._routes[self._next_route % len(self._routes)]
+                self._next_route += 1
+            else:
+                coordinates = None
+        if coordinates is None:
+            coordinates = synthetic_route(source, target)
+        length = sum(great_circle_distance(a, b) for a, b in zip(coordinates, coordinates[1:]))
+        return int(length / SPEED), length, coordinates
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if urlparse(self.path).path != '/route':
+                    self.send_error(404)
+                    return
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                source, target = ((location['lon'], location['lat']) for location in request['locations'])
+                cost, length, coordinates = server.route(source, target)
+                self._respond({'trip': {'legs': [{'shape': encode(coordinates)}],
+                                        'summary': {'time': cost, 'length': length / 1000}}})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/brouter':
+                    self.send_error(404)
+                    return
+                lonlats = parse_qs(url.query)['lonlats'][0].split('|')
+                source, target = (tuple(map(float, lonlat.split(','))) for lonlat in lonlats)
+                cost, length, coordinates = server.route(source, target)
+                self._respond({'type': 'FeatureCollection', 'features': [{
+                    'type': 'Feature',
+                    'properties': {'total-time': str(cost), 'track-length': str(int(length))},
+                    'geometry': {'type': 'LineString', 'coordinates': [[lon, lat, 0] for lon, lat in coordinates]}}]})
+
+            def _respond(self, result):
+                time.sleep(server._latency)
+                body = json.dumps(result).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
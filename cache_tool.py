@@ -0,0 +1,72 @@
+import argparse
+import re
+import sys
+
+from caching import Cache
+from caching.maintenance import PREFER_SOURCE, PREFER_TARGET, compact, evict, gc, merge, statistics
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value):
+    """
+    Parse a size like 500M.
+    :return: the size in bytes
+    """
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)B?', value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f'invalid size {value!r}, expected e.g. 500M or 2G')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+if __name__ == '__main__':
+    '''
+    This script maintains the route cache: merge the caches of several machines, remove orphaned route files and keep
+    the route files within a size budget
+    '''
+    parser = argparse.ArgumentParser(description='Maintains the SUCH route cache')
+    parser.add_argument('-c', '--cache', type=str, default='.such_route_cache',
+                        help='The cache to maintain')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('stats', help='Show the number of connections per backend and the size of the route files')
+
+    merge_parser = commands.add_parser('merge', help='Merge other caches into the cache')
+    merge_parser.add_argument('sources', nargs='+', help='The caches to merge')
+    merge_parser.add_argument('--prefer', choices=[PREFER_TARGET, PREFER_SOURCE], default=PREFER_TARGET,
+                              help='Which value to keep for a connection in both caches')
+    merge_parser.add_argument('-b', '--backend', action='append', default=None,
+                              help='Only merge the connections of this backend, can be given multiple times')
+
+    commands.add_parser('gc', help='Remove route files without a connection in the cache')
+    commands.add_parser('compact', help='Remove orphaned and unreadable route files and rewrite the cache')
+
+    evict_parser = commands.add_parser('evict', help='Remove route files until they fit into the budget')
+    evict_parser.add_argument('budget', type=parse_size, help='Maximum size of the route files, e.g. 500M')
+    evict_parser.add_argument('--least-useful', action='store_true',
+                              help='Evict the least often used routes first instead of the least recently used ones')
+
+    args = parser.parse_args()
+
+    cache = Cache(args.cache, None)
+    cache.load()
+
+    if args.command == 'stats':
+        result = statistics(cache)
+        for backend, count in sorted(result['connections'].items()):
+            print(f'{backend}: {count} connections')
+        print(f'{result["entries"]} other entries, {result["files"]} route files, '
+              f'{result["bytes"] / 1024 ** 2:.1f} MiB')
+    elif args.command == 'merge':
+        result = merge(cache, args.sources, prefer=args.prefer, backends=args.backend)
+        print(f'merged {result["entries"]} entries and {result["files"]} route files, '
+              f'{result["conflicts"]} conflicts')
+    elif args.command == 'gc':
+        print(f'removed {gc(cache)} route files')
+    elif args.command == 'compact':
+        result = compact(cache)
+        for filename, error in sorted(result['unreadable'].items()):
+            print(f'removed unreadable route file {filename}: {error}', file=sys.stderr)
+        print(f'removed {result["orphaned"]} orphaned and {len(result["unreadable"])} unreadable route files')
+    elif args.command == 'evict':
+        print(f'removed {evict(cache, args.budget, args.least_useful) / 1024 ** 2:.1f} MiB of route files')
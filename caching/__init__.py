@@ -1,14 +1,84 @@
+import math
 import os
 import pickle
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Iterable, Tuple
 
+from metrics import metrics
+
+# version of the key format, caches without version use the raw float tuples in their keys
+VERSION_KEY = ':version'
+VERSION = 2
+# coordinates are stored in micro-degrees
+PRECISION = 1e6
+# meters per micro-degree of latitude
+METERS_PER_UNIT = 0.111195
+# the longitude of a micro-degree shrinks with the latitude, the grid is wide enough up to this latitude
+MAX_LATITUDE = 60
+# tolerances in degrees of the simplified levels of detail of a route, level 0 is the full geometry
+ROUTE_TOLERANCES = (0.0, 0.0001, 0.001)
+# level of detail for the intersection with the cantons, about 100m
+COARSE_LEVEL = 2
+
+OLD_CONNECTION_KEY = re.compile(r'^([^:]+):\(([^,]+), ([^)]+)\):\(([^,]+), ([^)]+)\)(.*)$')
+OLD_STATION_KEY = re.compile(r'^(station|station_cost):([^,]+),([^,]+)$')
+CONNECTION_KEY = re.compile(r'^[^:]+:(-?\d+),(-?\d+):(-?\d+),(-?\d+)')
+
+
+def quantize(coordinate: (float, float)) -> (int, int):
+    """
+    Round the coordinates to integer micro-degrees, the same location always results in the same key.
+    :param coordinate: tuple of two coordinates in degrees
+    :return: tuple of two coordinates in micro-degrees
+    """
+    return round(coordinate[0] * PRECISION), round(coordinate[1] * PRECISION)
+
+
+def coordinate_key(coordinate: (float, float)) -> str:
+    return '{},{}'.format(*quantize(coordinate))
+
+
+def route_level_key(route_key, level):
+    return route_key if not level else f'{route_key}:lod{level}'
+
 
 class Cache:
-    def __init__(self, filename, algorithm):
+    def __init__(self, filename, algorithm, snap_tolerance=None):
+        """
+        :param filename: filename of the cache
+        :param algorithm: name of the routing algorithm
+        :param snap_tolerance: if given, an endpoint within this distance in meters of an endpoint already in the
+        cache is replaced by the cached one
+        """
         self._filename = filename
         self._algorithm = algorithm
         self._cache = {}
         self._dirname = self._filename + '_files'
+        self._snap_tolerance = snap_tolerance
+        # grid of the known endpoints for snapping
+        self._grid_size = math.ceil(snap_tolerance / (METERS_PER_UNIT * math.cos(math.radians(MAX_LATITUDE))))\
+            if snap_tolerance else None
+        self._endpoints = {}
+        # sidecar with the last access and the number of accesses of every file, used to evict files
+        self._usage_filename = self._filename + '.usage'
+        self._usage = {}
+        # entries set since track_changes, None if the changes are not tracked
+        self._changes = None
+        self.hits = 0
+        self.snapped_hits = 0
+        self.misses = 0
+
+    @property
+    def dirname(self):
+        return self._dirname
+
+    def items(self):
+        return self._cache.items()
+
+    def __contains__(self, key):
+        return key in self._cache
     
     def load(self):
         print('load cache')
@@ -17,11 +87,102 @@ class Cache:
                 self._cache = pickle.load(f)
         if not os.path.exists(self._dirname):
             os.mkdir(self._dirname)
-                
+        if os.path.exists(self._usage_filename):
+            with open(self._usage_filename, 'rb') as f:
+                self._usage = pickle.load(f)
+        if self._cache.get(VERSION_KEY) != VERSION:
+            self._migrate()
+        if self._snap_tolerance:
+            prefix = f'{self._algorithm}:'
+            for key in self._cache:
+                if key.startswith(prefix):
+                    start, dest = key[len(prefix):].split(':')[:2]
+                    self._add_endpoint(tuple(map(int, start.split(','))))
+                    self._add_endpoint(tuple(map(int, re.match(r'-?\d+,-?\d+', dest).group(0).split(','))))
+
+    def _migrate(self):
+        """
+        Rewrite the keys and route files of a cache created before the coordinates were quantized.
+        """
+        self._cache = {self._migrate_key(key): value for key, value in self._cache.items()}
+        self._cache[VERSION_KEY] = VERSION
+        for filename in os.listdir(self._dirname):
+            migrated_filename = self._migrate_key(filename)
+            if migrated_filename != filename:
+                os.replace(os.path.join(self._dirname, filename), os.path.join(self._dirname, migrated_filename))
+
+    @staticmethod
+    def _migrate_key(key):
+        if not isinstance(key, str):
+            return key
+        if match := OLD_CONNECTION_KEY.match(key):
+            algorithm, start_lon, start_lat, dest_lon, dest_lat, suffix = match.groups()
+            start = coordinate_key((float(start_lon), float(start_lat)))
+            dest = coordinate_key((float(dest_lon), float(dest_lat)))
+            return f'{algorithm}:{start}:{dest}{suffix}'
+        if match := OLD_STATION_KEY.match(key):
+            prefix, first, second = match.groups()
+            return f'{prefix}:{coordinate_key((float(first), float(second)))}'
+        return key
+
+    def _cell(self, point):
+        return point[0] // self._grid_size, point[1] // self._grid_size
+
+    def _add_endpoint(self, point):
+        self._endpoints.setdefault(self._cell(point), set()).add(point)
+
+    def _snap(self, point):
+        """
+        Find the nearest known endpoint within the tolerance.
+        :param point: quantized coordinates: tuple of (lon, lat)
+        :return: the known endpoint or the point itself
+        """
+        if not self._snap_tolerance:
+            return point
+        cell_lon, cell_lat = self._cell(point)
+        scale_lon = METERS_PER_UNIT * math.cos(math.radians(point[1] / PRECISION))
+        nearest = None
+        nearest_distance = self._snap_tolerance
+        for lon in (cell_lon - 1, cell_lon, cell_lon + 1):
+            for lat in (cell_lat - 1, cell_lat, cell_lat + 1):
+                for endpoint in self._endpoints.get((lon, lat), ()):
+                    distance = math.hypot((endpoint[0] - point[0]) * scale_lon,
+                                          (endpoint[1] - point[1]) * METERS_PER_UNIT)
+                    if distance <= nearest_distance:
+                        nearest = endpoint
+                        nearest_distance = distance
+        return nearest or point
+
+    def station_key(self, near_point: (float, float)) -> str:
+        return f'station:{coordinate_key(near_point)}'
+
+    def station_cost_key(self, position: (float, float)) -> str:
+        return f'station_cost:{coordinate_key(position)}'
+
+    @metrics.timed('cache.save')
     def save(self):
         print('save cache')
-        with open(self._filename, 'wb') as f:
+        # write to a temporary file first, so an interruption never leaves a truncated cache behind
+        temporary_filename = self._filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
             pickle.dump(self._cache, f)
+        os.replace(temporary_filename, self._filename)
+        with open(self._usage_filename + '.tmp', 'wb') as f:
+            pickle.dump(self._usage, f)
+        os.replace(self._usage_filename + '.tmp', self._usage_filename)
+
+    def usage(self, key):
+        """
+        :param key: the key of a file
+        :return: tuple of the time of the last access and the number of accesses, (None, 0) if unknown
+        """
+        return self._usage.get(key, (None, 0))
+
+    def forget_usage(self, key):
+        self._usage.pop(key, None)
+
+    def _touch(self, key):
+        self._usage[key] = (time.time(), self._usage.get(key, (None, 0))[1] + 1)
             
     def _get_key(self, start: (float, float), dest: (float, float), cantons=None) -> str:
         """
@@ -31,7 +192,10 @@ class Cache:
         :param cantons: list of cantons which will be avoided
         :return: the key for the given parameter set
         """
-        key = f'{self._algorithm}:{start}:{dest}'
+        return self._key(self._snap(quantize(start)), self._snap(quantize(dest)), cantons)
+
+    def _key(self, start: (int, int), dest: (int, int), cantons=None) -> str:
+        key = f'{self._algorithm}:{start[0]},{start[1]}:{dest[0]},{dest[1]}'
         if cantons:
             key = key + ','.join(map(lambda x: x.code, cantons))
         return key
@@ -39,6 +203,7 @@ class Cache:
     def get_route_key(self, start: (float, float), dest: (float, float), cantons=None) -> str:
         return self._get_key(start, dest, cantons) + ':route'
 
+    @metrics.timed('cache.get')
     def get(self, start: (float, float), dest: (float, float), cantons=None) -> Optional[Tuple[int, float]]:
         """
         Get a cache value from the given parameters.
@@ -47,9 +212,18 @@ class Cache:
         :param cantons: list of cantons which will be avoided
         :return: the cached value on a hit, otherwise None
         """
-        key = self._get_key(start, dest, cantons)
+        start, dest = quantize(start), quantize(dest)
+        snapped_start, snapped_dest = self._snap(start), self._snap(dest)
+        key = self._key(snapped_start, snapped_dest, cantons)
         if key in self._cache:
+            self.hits += 1
+            metrics.count('cache.hit')
+            if (snapped_start, snapped_dest) != (start, dest):
+                self.snapped_hits += 1
+                metrics.count('cache.snapped_hit')
             return self._cache[key]
+        self.misses += 1
+        metrics.count('cache.miss')
         return None
     
     def get_all(self, start: (float, float), dest: (float, float)) -> Iterable[Tuple[int, float]]:
@@ -64,6 +238,7 @@ class Cache:
             if key.startswith(key_template):
                 yield self._cache[key]
     
+    @metrics.timed('cache.set')
     def set(self, value: (int, float), start: (float, float), dest: (float, float), cantons=None):
         """
         Set the key value pair in the cache
@@ -72,8 +247,41 @@ class Cache:
         :param dest: destination coordinates: tuple of (lon, lat)
         :param cantons: list of cantons which will be avoided
         """
-        key = self._get_key(start, dest, cantons)
+        start, dest = self._snap(quantize(start)), self._snap(quantize(dest))
+        if self._snap_tolerance:
+            self._add_endpoint(start)
+            self._add_endpoint(dest)
+        key = self._key(start, dest, cantons)
         self._cache[key] = value
+        if self._changes is not None:
+            self._changes[key] = value
+
+    def track_changes(self):
+        """
+        Record the connections set from now on, e.g. in a worker process, whose copy of the cache is never saved.
+        """
+        self._changes = {}
+
+    def pop_changes(self) -> dict:
+        """
+        :return: dict of the keys to the values of the connections set since the last call or track_changes
+        """
+        changes = self._changes or {}
+        if self._changes is not None:
+            self._changes = {}
+        return changes
+
+    def update(self, entries: dict):
+        """
+        Add the entries of another copy of the cache, e.g. the result of pop_changes in a worker process.
+        :param entries: dict of keys to values
+        """
+        for key, value in entries.items():
+            self._cache[key] = value
+            if self._snap_tolerance and (match := CONNECTION_KEY.match(key)):
+                start_lon, start_lat, dest_lon, dest_lat = map(int, match.groups())
+                self._add_endpoint((start_lon, start_lat))
+                self._add_endpoint((dest_lon, dest_lat))
 
     def set_generic(self, key, value):
         """
@@ -83,6 +291,37 @@ class Cache:
         """
         self._cache[key] = value
 
+    def delete_generic(self, key):
+        self._cache.pop(key, None)
+
+    def invalidate(self, coordinates: Iterable[Tuple[float, float]]) -> int:
+        """
+        Remove the connections of every routing algorithm from or to the given coordinates and their route files.
+        :param coordinates: coordinates: tuples of (lon, lat)
+        :return: the number of removed connections
+        """
+        points = {quantize(coordinate) for coordinate in coordinates}
+
+        def touches(key):
+            match = CONNECTION_KEY.match(key) if isinstance(key, str) else None
+            if not match:
+                return False
+            start_lon, start_lat, dest_lon, dest_lat = map(int, match.groups())
+            return (start_lon, start_lat) in points or (dest_lon, dest_lat) in points
+
+        removed = [key for key in self._cache if touches(key)]
+        for key in removed:
+            del self._cache[key]
+        if os.path.exists(self._dirname):
+            for filename in os.listdir(self._dirname):
+                if touches(filename):
+                    os.remove(os.path.join(self._dirname, filename))
+                    self._usage.pop(filename, None)
+        if self._snap_tolerance:
+            for point in points:
+                self._endpoints.get(self._cell(point), set()).discard(point)
+        return len(removed)
+
     def get_generic(self, key):
         """
         Generic get function for the key. The key ist just passed through.
@@ -93,15 +332,56 @@ class Cache:
             return self._cache[key]
         return None
 
+    @metrics.timed('cache.get_file')
     def get_file(self, key):
         filename = os.path.join(self._dirname, key)
         if os.path.exists(filename):
+            self._touch(key)
             with open(filename, 'rb') as f:
                 return pickle.load(f)
 
         return None
 
+    @metrics.timed('cache.set_file')
     def set_file(self, key, value):
         filename = os.path.join(self._dirname, key)
         with open(filename, 'wb') as f:
             pickle.dump(value, f)
+        self._touch(key)
+
+    def get_route_file(self, route_key, level=0):
+        """
+        Get a route in the given level of detail. The level is created from the full geometry, if it is missing, e.g.
+        for routes cached before the levels of detail were introduced.
+        :param route_key: the key of the route
+        :param level: index of the tolerance in ROUTE_TOLERANCES
+        :return: the LineString of the route or None
+        """
+        route = self.get_file(route_level_key(route_key, level))
+        if route is None and level:
+            route = self.get_file(route_key)
+            if route is not None:
+                route = route.simplify(ROUTE_TOLERANCES[level], preserve_topology=True)
+                self.set_file(route_level_key(route_key, level), route)
+        return route
+
+    def get_route_files(self, route_keys, level=0):
+        """
+        Get many routes at once, the files are read concurrently.
+        :param route_keys: the keys of the routes
+        :param level: index of the tolerance in ROUTE_TOLERANCES
+        :return: list of the LineStrings of the routes, None for a missing route
+        """
+        with ThreadPoolExecutor() as executor:
+            return list(executor.map(lambda route_key: self.get_route_file(route_key, level), route_keys))
+
+    def set_route_file(self, route_key, route):
+        """
+        Store a route with all its simplified levels of detail.
+        :param route_key: the key of the route
+        :param route: LineString of the route
+        """
+        self.set_file(route_key, route)
+        for level in range(1, len(ROUTE_TOLERANCES)):
+            self.set_file(route_level_key(route_key, level),
+                          route.simplify(ROUTE_TOLERANCES[level], preserve_topology=True))
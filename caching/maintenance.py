@@ -0,0 +1,169 @@
+import os
+import pickle
+import shutil
+from typing import Iterable, Optional
+
+from caching import CONNECTION_KEY, VERSION_KEY, Cache
+
+# route files are named by the key of their connection and this suffix, followed by the level of detail
+ROUTE_SUFFIX = ':route'
+# conflict resolution of a merge, the value of the target or the source cache is kept
+PREFER_TARGET = 'target'
+PREFER_SOURCE = 'source'
+
+
+def connection_key(filename) -> str:
+    """
+    :param filename: the name of a route file
+    :return: the key of the connection the route file belongs to
+    """
+    return filename.split(ROUTE_SUFFIX)[0]
+
+
+def backend_of(key) -> Optional[str]:
+    """
+    :return: the routing algorithm of a connection key, None for every other key
+    """
+    if isinstance(key, str) and CONNECTION_KEY.match(key):
+        return key.split(':', 1)[0]
+    return None
+
+
+def merge(target: Cache, filenames: Iterable[str], prefer=PREFER_TARGET, backends=None) -> dict:
+    """
+    Merge other caches, e.g. of several machines, into the target cache. The sources are loaded one after the other,
+    the route files are copied one by one. Connections of different backends never conflict, because the routing
+    algorithm is part of the key.
+
+    Limits: every source is loaded completely into memory, like the target, so merging needs about the memory of the
+    two largest caches. The conflict resolution applies to all backends, merge the backends one by one to resolve
+    their conflicts differently.
+    :param target: the loaded cache to merge into
+    :param filenames: filenames of the caches to merge
+    :param prefer: PREFER_TARGET or PREFER_SOURCE, which value to keep for a key in both caches
+    :param backends: only merge the connections of these routing algorithms, all if None
+    :return: dict with the number of merged entries, conflicts and copied files
+    """
+    merged = {'entries': 0, 'conflicts': 0, 'files': 0}
+    for filename in filenames:
+        source = Cache(filename, None)
+        # migrates an old source cache to the current key format
+        source.load()
+        taken = set()
+        # connections with the same value in both caches, their route files are only copied, if the target lacks them
+        identical = set()
+        for key, value in source.items():
+            if key == VERSION_KEY or (backends and backend_of(key) and backend_of(key) not in backends):
+                continue
+            if key in target:
+                if target.get_generic(key) == value:
+                    identical.add(key)
+                    continue
+                merged['conflicts'] += 1
+                if prefer == PREFER_TARGET:
+                    continue
+            target.set_generic(key, value)
+            taken.add(key)
+            merged['entries'] += 1
+
+        # the route files follow the decision about their connection
+        for route_filename in os.listdir(source.dirname):
+            key = connection_key(route_filename)
+            destination = os.path.join(target.dirname, route_filename)
+            if key not in taken and (key not in identical or os.path.exists(destination)):
+                continue
+            shutil.copyfile(os.path.join(source.dirname, route_filename), destination + '.tmp')
+            os.replace(destination + '.tmp', destination)
+            merged['files'] += 1
+    target.save()
+    return merged
+
+
+def gc(cache: Cache) -> int:
+    """
+    Remove the route files, whose connection is not in the cache anymore, e.g. after a change of the key format, and
+    the leftovers of interrupted writes.
+    :return: the number of removed files
+    """
+    removed = 0
+    for filename in os.listdir(cache.dirname):
+        if filename.endswith('.tmp') or connection_key(filename) not in cache:
+            _remove(cache, filename)
+            removed += 1
+    cache.save()
+    return removed
+
+
+def compact(cache: Cache) -> dict:
+    """
+    Remove orphaned and unreadable route files and rewrite the cache.
+    :return: dict with the number of removed orphaned files and a dict of the unreadable files to their error
+    """
+    orphaned = gc(cache)
+    unreadable = {}
+    for filename in os.listdir(cache.dirname):
+        try:
+            with open(os.path.join(cache.dirname, filename), 'rb') as f:
+                pickle.load(f)
+        except Exception as error:
+            # a truncated or foreign file fails in many ways, e.g. with an AttributeError for an unknown class
+            unreadable[filename] = f'{type(error).__name__}: {error}'
+            _remove(cache, filename)
+    cache.save()
+    return {'orphaned': orphaned, 'unreadable': unreadable}
+
+
+def evict(cache: Cache, budget, least_useful=False) -> int:
+    """
+    Remove route files until the route files fit into the budget. All levels of detail of a route are removed
+    together with the connection, so it is routed again when it is needed.
+    :param budget: maximum size of the route files in bytes
+    :param least_useful: evict the least often used routes first instead of the least recently used ones
+    :return: the number of removed bytes
+    """
+    routes = {}
+    total = 0
+    for filename in os.listdir(cache.dirname):
+        stat = os.stat(os.path.join(cache.dirname, filename))
+        last_access, accesses = cache.usage(filename)
+        route = routes.setdefault(connection_key(filename), {'files': [], 'size': 0, 'last_access': 0, 'accesses': 0})
+        route['files'].append(filename)
+        route['size'] += stat.st_size
+        # files without recorded usage were last used when they were written
+        route['last_access'] = max(route['last_access'], last_access or stat.st_mtime)
+        route['accesses'] += accesses
+        total += stat.st_size
+
+    removed = 0
+    order = (lambda route: (route['accesses'], route['last_access'])) if least_useful \
+        else (lambda route: route['last_access'])
+    for key, route in sorted(routes.items(), key=lambda item: order(item[1])):
+        if total - removed <= budget:
+            break
+        for filename in route['files']:
+            _remove(cache, filename)
+        cache.delete_generic(key)
+        removed += route['size']
+    cache.save()
+    return removed
+
+
+def statistics(cache: Cache) -> dict:
+    """
+    :return: dict with the number of connections per backend, the number of other entries, route files and their size
+    """
+    connections = {}
+    entries = 0
+    for key, _ in cache.items():
+        if backend := backend_of(key):
+            connections[backend] = connections.get(backend, 0) + 1
+        else:
+            entries += 1
+    filenames = os.listdir(cache.dirname)
+    return {'connections': connections, 'entries': entries, 'files': len(filenames),
+            'bytes': sum(os.path.getsize(os.path.join(cache.dirname, filename)) for filename in filenames)}
+
+
+def _remove(cache, filename):
+    os.remove(os.path.join(cache.dirname, filename))
+    cache.forget_usage(filename)
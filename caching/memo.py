@@ -0,0 +1,63 @@
+import hashlib
+import os
+import pickle
+from typing import Optional, List, Tuple
+
+from caching import quantize
+
+
+def matrix_hash(matrix, station_costs, estimated=None, nogos=None) -> str:
+    """
+    Content address of a distance matrix, identical matrices of different variants have the same hash.
+    :param matrix: distance matrix: dict of coordinates to dict of coordinates to the cost
+    :param station_costs: dict of coordinates to the cost to reach them from the nearest station
+    :param estimated: pairs of coordinates with estimated costs, they are refined depending on the nogos
+    :param nogos: codes of the avoided cantons, only relevant for estimated costs
+    :return: hex digest of the hash
+    """
+    digest = hashlib.sha256()
+    coordinates = sorted(matrix, key=quantize)
+    for source in coordinates:
+        digest.update(repr((quantize(source), station_costs.get(source))).encode())
+        for target in coordinates:
+            if target in matrix[source]:
+                digest.update(repr((quantize(target), matrix[source][target])).encode())
+    if estimated:
+        for source, target in sorted(estimated, key=lambda pair: (quantize(pair[0]), quantize(pair[1]))):
+            digest.update(repr((quantize(source), quantize(target))).encode())
+        digest.update(repr(sorted(nogos or [])).encode())
+    return digest.hexdigest()
+
+
+class TourMemo:
+    """
+    Persistent store of the solved tours by the hash of their distance matrix.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._tours = {}
+
+    def load(self):
+        if os.path.exists(self._filename):
+            with open(self._filename, 'rb') as f:
+                self._tours = pickle.load(f)
+
+    def save(self):
+        temporary_filename = self._filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
+            pickle.dump(self._tours, f)
+        os.replace(temporary_filename, self._filename)
+
+    def get(self, key) -> Optional[Tuple[float, List[Tuple[Tuple[float, float], float]]]]:
+        """
+        Get a solved tour.
+        :param key: hash of the distance matrix
+        :return: tuple of the cost and the list of (coordinates, time) in the order of the tour, None otherwise
+        """
+        return self._tours.get(key)
+
+    def set(self, key, cost, tour):
+        self._tours[key] = (cost, tour)
+
+    def __contains__(self, key):
+        return key in self._tours
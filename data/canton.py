@@ -1,7 +1,13 @@
 import geojson
+import shapely
 from OSMPythonTools.overpass import Overpass
 from shapely import Polygon, LineString, MultiPolygon
 
+from metrics import metrics
+
+# the buffers approximate arcs by chords, which are up to 0.5% closer than the tolerance with the default segments
+BUFFER_MARGIN = 1.01
+
 
 def create_shapely_polygons(geometry):
     polygons = []
@@ -37,6 +43,10 @@ class Canton:
             polygon = get_polygon_from_canton_code(code)
             cache.set_generic(code, polygon)
             self.polygon = polygon
+        # the index of the border is built once for all intersections, a prepared geometry has to be the first argument
+        shapely.prepare(self.polygon)
+        # prepared pairs of the polygon shrunk and grown by the tolerance of a simplified route
+        self._buffered = {}
 
     @staticmethod
     def line_from_geojson(route_file):
@@ -60,9 +70,41 @@ class Canton:
         polyline = LineString(coordinates)
         return polyline
 
-    def intersect(self, polyline):
-        # Check if the LineString intersects with the Polygon
-        intersects = polyline.intersects(self.polygon)
-        return bool(intersects)
-
-
+    @metrics.timed('canton.intersect')
+    def intersect(self, polyline, tolerance=0.0, full_route=None):
+        """
+        Check if the route intersects with the canton. A simplified route decides without the full geometry, unless
+        it is closer to the border than the tolerance of the simplification.
+        :param polyline: LineString of the route, possibly simplified
+        :param tolerance: maximum distance between the simplified and the full route in degrees
+        :param full_route: function loading the full route, it is only called near the border
+        """
+        if not tolerance:
+            return bool(self.polygon.intersects(polyline))
+        eroded, dilated = self._buffers(tolerance)
+        # the full route is within the tolerance of the simplified one
+        if not dilated.intersects(polyline):
+            return False
+        if eroded.intersects(polyline):
+            return True
+        metrics.count('canton.intersect.full_route')
+        route = full_route() if full_route else None
+        return bool(self.polygon.intersects(route if route is not None else polyline))
+
+    def _buffers(self, tolerance):
+        """
+        Shrink and grow the polygon by the tolerance. The buffers are created once per tolerance from the border
+        simplified by half the tolerance, which is much faster. The simplified border is within half the tolerance of
+        the real one, so the buffers are larger by this distance.
+        :return: tuple of the prepared polygons shrunk and grown by the tolerance
+        """
+        if tolerance not in self._buffered:
+            simplified = self.polygon.simplify(tolerance / 2, preserve_topology=False)
+            # the fast simplification may create invalid polygons or drop small rings like exclaves
+            if not simplified.is_valid or len(shapely.get_rings(simplified)) != len(shapely.get_rings(self.polygon)):
+                simplified = self.polygon.simplify(tolerance / 2, preserve_topology=True)
+            distance = tolerance * 1.5 * BUFFER_MARGIN
+            buffered = (simplified.buffer(-distance), simplified.buffer(distance))
+            shapely.prepare(buffered)
+            self._buffered[tolerance] = buffered
+        return self._buffered[tolerance]
@@ -18,7 +18,7 @@ class NearestStation:
         self._near_point = near_point
         self._cost = None
         if not position:
-            if cache_hit := cache.get_generic(f'station:{near_point[0]},{near_point[1]}'):
+            if cache_hit := cache.get_generic(cache.station_key(near_point)):
                 self._position = cache_hit
             else:
                 overpass = Overpass(endpoint='https://overpass.kumi.systems/api/')
@@ -44,18 +44,18 @@ class NearestStation:
                     if cost < self._cost:
                         self._cost = cost
                         self._position = (coords[0], coords[1])
-                cache.set_generic(f'station:{near_point[0]},{near_point[1]}', self._position)
-                cache.set_generic(f'station_cost:{self._position[0]},{self._position[1]}', self._cost)
+                cache.set_generic(cache.station_key(near_point), self._position)
+                cache.set_generic(cache.station_cost_key(self._position), self._cost)
                 cache.save()
         if not self._cost:
-            if cache_hit := cache.get_generic(f'station_cost:{self._position[0]},{self._position[1]}'):
+            if cache_hit := cache.get_generic(cache.station_cost_key(self._position)):
                 self._cost = cache_hit
             else:
                 routing = routing_algorithm if routing_algorithm else Valhalla(cache)
                 cost, _, _ = routing.direct_connection(self._near_point[1], self._near_point[0], self._position[1],
                                                        self._position[0])
                 self._cost = cost
-                cache.set_generic(f'station_cost:{self._position[0]},{self._position[1]}', self._cost)
+                cache.set_generic(cache.station_cost_key(self._position), self._cost)
                 cache.save()
 
     def get_cost(self):
@@ -1,12 +1,16 @@
+import numpy as np
 import pandas as pd
 import folium
-from shapely import get_coordinates
+from shapely import get_coordinates, to_geojson
 
 from caching import Cache
 from data import Canton
 from data.station import NearestStation
+from registry import VALHALLA
 from routing.valhalla import Valhalla
-from such_route import VALHALLA
+
+# tolerance in degrees to simplify the outline of the avoided cantons, about 100m
+CANTON_TOLERANCE = 0.001
 
 
 class FoliumMap:
@@ -23,7 +27,11 @@ class FoliumMap:
         for code in avoid_canton_codes:
             self.avoid_cantons.append(Canton(code, self.cache))
 
-    def create_map(self, output_file="swiss_cantons_map.html"):
+    def create_map(self, output_file="swiss_cantons_map.html", level=1):
+        """
+        :param output_file: filename of the HTML map
+        :param level: level of detail of the routes, see caching.ROUTE_TOLERANCES
+        """
         foliumColors = ['blue', 'darkgreen', 'cadetblue', 'lightgray', 'purple', 'orange',
                         'darkred', 'lightblue', 'darkblue', 'darkpurple', 'pink', 'black', 'green', 'red']
 
@@ -48,47 +56,32 @@ class FoliumMap:
         start_station = NearestStation(self.cache, (route[0]['lat'], route[0]['lon']))
         route.insert(0, {'order': -1, 'lat': start_station.get_position()[1], 'lon': start_station.get_position()[0]})
 
-        for i in range(len(route)-1):
-            cur = route[i]
-            nex = route[i+1]
-            calculated_route = self.routing_service.cache_or_connection(cur['lon'], cur['lat'], nex['lon'],
-                                                                        nex['lat']).get_route()
-
-            route_coords = list(map(lambda y: [y[1].item(), y[0].item()], get_coordinates(calculated_route)))
-
+        route_keys = [self.routing_service.cache_or_connection(cur['lon'], cur['lat'], nex['lon'],
+                                                               nex['lat']).get_route_key()
+                      for cur, nex in zip(route, route[1:])]
+        legs = self.cache.get_route_files(route_keys, level)
+
+        # convert all legs at once, folium expects (lat, lon)
+        coordinates, leg_index = get_coordinates(legs, return_index=True)
+        boundaries = np.searchsorted(leg_index, np.arange(1, len(legs)))
+        for i, route_coords in enumerate(np.split(coordinates[:, ::-1], boundaries)):
+            if not len(route_coords):
+                continue
             # change color for the route from the station, to the first checkpoint
             color = 'orange' if i == 0 else 'blue'
 
             folium.PolyLine(
-                locations=route_coords,
+                locations=route_coords.tolist(),
                 color=color,
                 opacity=1,
                 smooth_factor=0,
             ).add_to(mymap)
 
         for canton in self.avoid_cantons:
-            polygon = canton.polygon
-            coords = list(map(lambda y: [y[1].item(), y[0].item()], get_coordinates(polygon)))
-            multi_ring = []
-            inner_ring = []
-            start_coord = None
-            for coord in coords:
-                if coord == start_coord:
-                    inner_ring.append(coord)
-                    multi_ring.append(inner_ring)
-                    inner_ring = []
-                    start_coord = None
-                    continue
-                if not start_coord:
-                    start_coord = coord
-                inner_ring.append(coord)
-
-            folium.Polygon(
-                locations=multi_ring,
-                color="red",
-                fillColor="red",
-                opacity=0.5,
-                smooth_factor=0,
+            folium.GeoJson(
+                to_geojson(canton.polygon.simplify(CANTON_TOLERANCE, preserve_topology=True)),
+                name=canton.code,
+                style_function=lambda _: {'color': 'red', 'fillColor': 'red', 'opacity': 0.5},
             ).add_to(mymap)
 
         # Save the map to an HTML file
@@ -0,0 +1,201 @@
+import cProfile
+import functools
+import inspect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# number of histogram buckets per power of two
+BUCKETS_PER_OCTAVE = 4
+
+
+class Histogram:
+    """
+    Timing histogram with logarithmic buckets, the memory usage is independent of the number of samples.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.minimum = seconds if self.minimum is None else min(self.minimum, seconds)
+        self.maximum = seconds if self.maximum is None else max(self.maximum, seconds)
+        # bucket by microseconds, everything below one microsecond ends up in the first bucket
+        bucket = math.floor(math.log2(max(seconds * 1e6, 1)) * BUCKETS_PER_OCTAVE)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, percent):
+        """
+        Approximate percentile, the upper bound of the bucket containing the nearest rank.
+        :param percent: the percentile between 0 and 100
+        :return: duration in seconds or None, if there are no samples
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(percent / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE) / 1e6, self.maximum)
+        return self.maximum
+
+    def merge(self, other: 'Histogram'):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'min': self.minimum, 'max': self.maximum,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'buckets': {str(bucket): count for bucket, count in sorted(self.buckets.items())}}
+
+    @classmethod
+    def from_dict(cls, value):
+        histogram = cls()
+        histogram.count = value['count']
+        histogram.total = value['total']
+        histogram.minimum = value['min']
+        histogram.maximum = value['max']
+        histogram.buckets = {int(bucket): count for bucket, count in value['buckets'].items()}
+        return histogram
+
+
+class Metrics:
+    """
+    Counters and timing histograms of the hot paths. Nothing is recorded, unless the metrics are enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.timings = {}
+        self._profile_prefix = None
+        self._profiling = False
+
+    def enable(self, profile_prefix=None):
+        """
+        Start recording.
+        :param profile_prefix: if given, every phase is profiled with cProfile and written to <prefix>-<phase>.prof
+        """
+        self.enabled = True
+        self._profile_prefix = profile_prefix
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, seconds):
+        if name not in self.timings:
+            self.timings[name] = Histogram()
+        self.timings[name].add(seconds)
+
+    @contextmanager
+    def measure(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """
+        Decorator recording the duration of every call of the function, coroutine functions are timed until the
+        coroutine is finished.
+        :param name: name of the timing histogram
+        """
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await function(*args, **kwargs)
+                    start = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    finally:
+                        self.record(name, time.perf_counter() - start)
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Tag a phase of the run. The duration is recorded as phase.<name> and the thread is renamed, so a sampling
+        profiler like py-spy shows the phase. In profiling mode, the phase is profiled with cProfile.
+        :param name: name of the phase
+        """
+        if not self.enabled:
+            yield
+            return
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = f'phase:{name}'
+        # cProfile does not support nested profilers, an inner phase is part of the profile of the outer one
+        profile = cProfile.Profile() if self._profile_prefix and not self._profiling else None
+        if profile:
+            self._profiling = True
+            profile.enable()
+        try:
+            with self.measure(f'phase.{name}'):
+                yield
+        finally:
+            if profile:
+                profile.disable()
+                profile.dump_stats(f'{self._profile_prefix}-{name}.prof')
+                self._profiling = False
+            thread.name = thread_name
+
+    def snapshot(self):
+        return {'counters': dict(self.counters),
+                'timings': {name: histogram.to_dict() for name, histogram in sorted(self.timings.items())}}
+
+    def merge(self, snapshot):
+        """
+        Add the values of a snapshot, e.g. recorded in a worker process.
+        :param snapshot: the result of snapshot()
+        """
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        for name, value in snapshot['timings'].items():
+            if name not in self.timings:
+                self.timings[name] = Histogram()
+            self.timings[name].merge(Histogram.from_dict(value))
+
+    def report(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+# the metrics of this process
+metrics = Metrics()
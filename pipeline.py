@@ -0,0 +1,160 @@
+import argparse
+import multiprocessing
+import queue
+
+from caching import Cache
+from caching.memo import TourMemo
+from metrics import metrics
+from registry import TSP, VALHALLA, backends, solvers
+from such_route import read_checkpoints
+from sweep import SweepRunner
+from tsp_solver import VariantSolver, init_worker, load_stations, solve_variant
+
+
+class SolverQueue:
+    """
+    Solves the variants in worker processes as soon as their distance matrix is routed. Identical matrices are only
+    solved once and the solved tours are kept in the memo.
+    The workers are forked before the sweep and only know the cache from before. So the estimated connections of a
+    tour are routed by the main process, which solves the variant again, and never by several workers.
+    """
+    def __init__(self, pool, variant_solver: VariantSolver, memo: TourMemo):
+        self._pool = pool
+        self._variant_solver = variant_solver
+        self._memo = memo
+        self._solved = queue.Queue()
+        self._in_flight = set()
+        # distance matrix, estimated connections and avoided cantons of every variant in flight
+        self._variants = {}
+        # key of the matrix of every variant
+        self.keys = []
+
+    def put(self, nogos, result_matrix, estimated):
+        codes = [canton.code for canton in nogos or []]
+        key = self._variant_solver.hash(result_matrix, estimated, codes)
+        self.keys.append(key)
+        if key not in self._memo and key not in self._in_flight:
+            self._in_flight.add(key)
+            # the connections refined for other variants are filled in
+            self._submit(key, *self._variant_solver.fill_cached(result_matrix, estimated, nogos), nogos)
+        self.collect(block=False)
+
+    def _submit(self, key, result_matrix, estimated, nogos):
+        self._variants[key] = (result_matrix, estimated, nogos)
+        codes = [canton.code for canton in nogos or []]
+        self._pool.apply_async(solve_variant, ((key, result_matrix, estimated, codes),), {'refine': False},
+                               callback=self._solved.put, error_callback=self._solved.put)
+
+    def collect(self, block=True):
+        """
+        Store the solved tours in the memo, a tour using estimated connections is refined and solved again instead.
+        :param block: wait until every variant is solved, only take the already solved ones otherwise
+        """
+        while self._in_flight:
+            try:
+                result = self._solved.get(block=block)
+            except queue.Empty:
+                return
+            if isinstance(result, BaseException):
+                raise result
+            # the workers do not route, so they never change the cache
+            key, cost, tour, snapshot, _ = result
+            if snapshot:
+                metrics.merge(snapshot)
+            result_matrix, estimated, nogos = self._variants[key]
+            if estimated and (refined := self._variant_solver.refine(result_matrix, estimated, tour, nogos)):
+                self._submit(key, *refined, nogos)
+                continue
+            del self._variants[key]
+            self._in_flight.remove(key)
+            self._memo.set(key, cost, tour)
+            print(f'solved tour of {cost:.0f}s, best {self.best()[0]:.0f}s, {len(self._in_flight)} in progress',
+                  flush=True)
+
+    def best(self):
+        """
+        :return: tuple of the cost and the tour of the best solved variant
+        """
+        return min((self._memo.get(key) for key in set(self.keys) if key in self._memo),
+                   key=lambda solved: solved[0])
+
+
+if __name__ == '__main__':
+    '''
+    This script routes the distance matrix of every variant and solves its TSP, while the next variants are routed
+    '''
+    parser = argparse.ArgumentParser(description='Creates the distance matrices and solves the TSP of the SUCH route')
+
+    parser.add_argument('-f', '--filename', type=str, default='checkpoints.csv',
+                        help='The checkpoint csv file')
+    parser.add_argument('-b', '--backend', type=str, choices=backends.names(), default=VALHALLA,
+                        help='The routing backend')
+    parser.add_argument('-s', '--solver', type=str, choices=solvers.names(), default=TSP,
+                        help='The solver of every variant')
+    parser.add_argument('-k', '--candidates', type=int, default=None,
+                        help='Only route the connections to the k nearest neighbours of every checkpoint and '
+                             'estimate the remaining ones')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only recalculate the variants containing checkpoints, which changed since the last run')
+    parser.add_argument('--snap', action='store_true',
+                        help='Reuse the cached routes of endpoints within a few meters of the requested ones')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Also write the distance matrices to the given directory, e.g. results')
+    parser.add_argument('-c', '--cpus', type=int, default=max(1, multiprocessing.cpu_count() - 1),
+                        help='Number of worker processes solving the TSP')
+    parser.add_argument('-m', '--metrics', type=str, default=None,
+                        help='Record timings of the hot paths and write them to the given JSON file')
+    parser.add_argument('-p', '--profile', type=str, default=None,
+                        help='Profile every phase with cProfile and write it to <PROFILE>-<phase>.prof')
+
+    args = parser.parse_args()
+
+    if args.metrics or args.profile:
+        metrics.enable(args.profile)
+
+    # pandas, shapely and the Overpass client are only imported after the arguments are parsed, so --help starts fast
+    import pandas as pd
+    from data import Canton
+    from data.scrambling import Scrambler
+
+    checkpoints = read_checkpoints(args.filename)
+    data = pd.read_csv(args.filename, sep=';', encoding='utf-8')
+    routing_backend = backends.load(args.backend)
+
+    cache = Cache('.such_route_cache', args.backend,
+                  snap_tolerance=routing_backend.SNAP_TOLERANCE if args.snap else None)
+    cache.load()
+
+    with metrics.phase('cantons'):
+        cantons = {i['code']: Canton(i['code'], cache) for i in checkpoints}
+    with metrics.phase('stations'):
+        stations = load_stations(cache, data)
+
+    cache.save()
+
+    with metrics.phase('variants'):
+        variants = Scrambler(checkpoints, cantons).calc_matrices()
+
+    memo = TourMemo('.such_route_tours')
+    memo.load()
+    variant_solver = VariantSolver(data, cache, stations, routing_backend, solvers.load(args.solver))
+    try:
+        # the workers are forked before the sweep, so they do not copy the routed matrices
+        with multiprocessing.Pool(args.cpus, initializer=init_worker, initargs=(variant_solver,)) as p:
+            solver_queue = SolverQueue(p, variant_solver, memo)
+            with metrics.phase('sweep'):
+                SweepRunner(routing_backend, cache, variants, directory=args.output, candidates=args.candidates,
+                            checkpoints=checkpoints, incremental=args.incremental).run(solver_queue.put)
+            with metrics.phase('solve'):
+                solver_queue.collect()
+    finally:
+        memo.save()
+        cache.save()
+
+    cost, tour = solver_queue.best()
+    variant_solver.order(tour).to_csv('checkpoints_ordered.csv', sep=';', encoding='utf-8', index=False)
+
+    print(f'cache: {cache.hits} hits, {cache.snapped_hits} of them snapped, {cache.misses} misses')
+
+    if args.metrics:
+        metrics.report(args.metrics)
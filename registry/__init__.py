@@ -0,0 +1,60 @@
+from importlib import import_module
+
+# entry point groups, other packages can add backends and solvers with entry points of these groups
+BACKENDS_GROUP = 'such_route.backends'
+SOLVERS_GROUP = 'such_route.solvers'
+
+# backends
+BROUTER = 'brouter'
+VALHALLA = 'valhalla'
+# solvers
+TSP = 'tsp'
+
+
+class Registry:
+    """
+    Plugins by name, given as references of the form module:attribute. The module of a plugin is only imported when
+    the plugin is loaded, so listing the plugins, e.g. for --help, does not import any heavy dependency.
+    """
+    def __init__(self, group, plugins):
+        """
+        :param group: the entry point group of the plugins
+        :param plugins: dict of the names of the builtin plugins to their references
+        """
+        self._group = group
+        self._plugins = dict(plugins)
+        self._discovered = False
+
+    def register(self, name, reference):
+        self._plugins[name] = reference
+
+    def _discover(self):
+        if self._discovered:
+            return
+        self._discovered = True
+        from importlib.metadata import entry_points
+        for entry_point in entry_points(group=self._group):
+            self._plugins.setdefault(entry_point.name, entry_point.value)
+
+    def names(self):
+        self._discover()
+        return sorted(self._plugins)
+
+    def load(self, name):
+        """
+        Import the plugin.
+        :param name: name of the plugin
+        :return: the referenced attribute, e.g. the class of a routing service
+        """
+        self._discover()
+        if name not in self._plugins:
+            raise KeyError(f'Unknown plugin {name} of {self._group}, available are {", ".join(self.names())}.')
+        module, _, attribute = self._plugins[name].partition(':')
+        plugin = import_module(module)
+        for part in attribute.split('.') if attribute else []:
+            plugin = getattr(plugin, part)
+        return plugin
+
+
+backends = Registry(BACKENDS_GROUP, {BROUTER: 'routing.brouter:Brouter', VALHALLA: 'routing.valhalla:Valhalla'})
+solvers = Registry(SOLVERS_GROUP, {TSP: 'tsp_solver:TspSolver'})
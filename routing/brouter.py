@@ -2,16 +2,84 @@ import io
 import json
 
 import requests
+import shapely
 
-from routing_service import RoutingService
+from metrics import metrics
+from routing_service import AsyncRoutingService, RoutingError, RoutingService
+
+# tolerance in degrees to simplify the nogo polygons, the request url would be too long otherwise
+NOGO_TOLERANCE = 0.01
+
+_nogo_polygons = {}
 
 
 class Brouter(RoutingService):
+    URL = 'http://localhost:17777'
+    # BRouter answers requests in parallel only if the server is started with maxthreads > 1
+    CONCURRENT_REQUESTS = 4
+    AVOIDS_NOGOS = True
+    SNAP_TOLERANCE = 10
+
     def matrix(self, coordinates):
-        return self._calc_matrix_from_coordinates(coordinates)
+        return self._run_concurrently(AsyncBrouter, lambda routing_service: routing_service.matrix(coordinates))
+
+    def sparse_matrix(self, coordinates, k):
+        return self._run_concurrently(AsyncBrouter,
+                                      lambda routing_service: routing_service.sparse_matrix(coordinates, k))
 
+    @metrics.timed('routing.brouter.direct_connection')
     def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
-        coords = f'{source_lon},{source_lat}|{target_lon},{target_lat}'
-        response = requests.get(f'http://localhost:17777/brouter?lonlats={coords}&profile=fastbike&format=geojson')
-        result = json.load(io.BytesIO(response.content))
-        return int(result['features'][0]['properties']['total-time'])
+        response = requests.get(f'{self.url}/brouter',
+                                params=request_parameters(self.nogos, source_lon, source_lat, target_lon, target_lat))
+        if response.status_code != 200:
+            raise RoutingError(response.text)
+        return parse_result(json.load(io.BytesIO(response.content)))
+
+
+class AsyncBrouter(AsyncRoutingService):
+    URL = Brouter.URL
+    CONCURRENT_REQUESTS = Brouter.CONCURRENT_REQUESTS
+    AVOIDS_NOGOS = Brouter.AVOIDS_NOGOS
+    SNAP_TOLERANCE = Brouter.SNAP_TOLERANCE
+
+    @metrics.timed('routing.brouter.direct_connection')
+    async def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
+        async with self.client.session.get(
+                f'{self.url}/brouter',
+                params=request_parameters(self.nogos, source_lon, source_lat, target_lon, target_lat)) as response:
+            if response.status != 200:
+                raise RoutingError(await response.text())
+            return parse_result(await response.json(content_type=None))
+
+
+def nogo_polygon(canton):
+    """
+    Create the polygons parameter of a canton to avoid: lon,lat pairs of the simplified outline, separated by commas,
+    one polygon for every part of the canton.
+    :param canton: the canton to avoid
+    :return: list of polygons
+    """
+    if canton.code not in _nogo_polygons:
+        simplified = canton.polygon.simplify(NOGO_TOLERANCE)
+        parts = simplified.geoms if isinstance(simplified, shapely.MultiPolygon) else [simplified]
+        _nogo_polygons[canton.code] = [
+            ','.join(f'{lon:.5f},{lat:.5f}' for lon, lat in part.exterior.coords) for part in parts if not part.is_empty]
+    return _nogo_polygons[canton.code]
+
+
+def request_parameters(nogos, source_lon, source_lat, target_lon, target_lat):
+    parameters = {'lonlats': f'{source_lon},{source_lat}|{target_lon},{target_lat}',
+                  'profile': 'fastbike',
+                  'format': 'geojson'}
+    if nogos:
+        parameters['polygons'] = '|'.join(polygon for canton in nogos for polygon in nogo_polygon(canton))
+    return parameters
+
+
+def parse_result(result):
+    feature = result['features'][0]
+    # drop the elevation, the route has the same shape as the ones of Valhalla
+    route = shapely.LineString([(lon, lat) for lon, lat, *_ in feature['geometry']['coordinates']])
+    # the track length is given in meters, Valhalla returns kilometers
+    return (int(feature['properties']['total-time']), float(feature['properties']['track-length']) / 1000,
+            route)
@@ -4,12 +4,14 @@ import json
 import requests
 import shapely
 
-from routing_service import RoutingService, RoutingError
+from metrics import metrics
+from routing_service import AsyncRoutingService, RoutingService, RoutingError
 
 inv = 1.0 / 1e6
 
 
 # decode an encoded string from https://valhalla.github.io/valhalla/decoding/
+@metrics.timed('routing.valhalla.decode')
 def decode(encoded):
     decoded = []
     previous = [0,0]
@@ -37,33 +39,77 @@ def decode(encoded):
     return decoded
 
 
+def encode(coordinates):
+    """
+    Encode coordinates with the polyline6 algorithm, the inverse of decode.
+    :param coordinates: list of (lon, lat)
+    :return: the encoded string
+    """
+    encoded = []
+    previous = [0, 0]
+    for lon, lat in coordinates:
+        for j, value in enumerate((round(lat * 1e6), round(lon * 1e6))):
+            delta = value - previous[j]
+            previous[j] = value
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                encoded.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            encoded.append(chr(delta + 63))
+    return ''.join(encoded)
+
+
 class Valhalla(RoutingService):
+    URL = 'http://localhost:8002'
+
     def matrix(self, coordinates):
-        return self._calc_matrix_from_coordinates(coordinates)
+        return self._run_concurrently(AsyncValhalla, lambda routing_service: routing_service.matrix(coordinates))
 
+    def sparse_matrix(self, coordinates, k):
+        return self._run_concurrently(AsyncValhalla,
+                                      lambda routing_service: routing_service.sparse_matrix(coordinates, k))
+
+    @metrics.timed('routing.valhalla.direct_connection')
     def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
-        json_data = {'locations': [{'lat': source_lat, 'lon': source_lon},
-                                   {'lat': target_lat, 'lon': target_lon}],
-                     'costing_options': {
-                       'bicycle': {
-                         'bicycle_type': 'road',
-                       }
-                     },
-                     'costing': 'bicycle'}
-        if not self._use_ferries:
-            # avoid _use_ferries if configured
-            json_data['costing_options']['bicycle']['use_ferry'] = 0
-        json_data['costing_options']['bicycle']['avoid_bad_surfaces'] = 0.8
-        json_data['costing_options']['bicycle']['use_roads'] = 0.8
-
-        response = requests.post('http://localhost:8002/route', json=json_data)
-        result = json.load(io.BytesIO(response.content))
-
-        if 'error' in result:
-            raise RoutingError(result['error'])
-
-        # assumption is, there is only one leg. otherwise we have to handle the result differently
-        assert len(result['trip']['legs']) == 1
-        decoded_route = decode(result['trip']['legs'][0]['shape'])
-        route = shapely.LineString(decoded_route)
-        return int(result['trip']['summary']['time']), float(result['trip']['summary']['length']), route
+        response = requests.post(f'{self.url}/route',
+                                 json=request_json(self._use_ferries, source_lon, source_lat, target_lon, target_lat))
+        return parse_result(json.load(io.BytesIO(response.content)))
+
+
+class AsyncValhalla(AsyncRoutingService):
+    URL = Valhalla.URL
+
+    @metrics.timed('routing.valhalla.direct_connection')
+    async def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
+        async with self.client.session.post(
+                f'{self.url}/route',
+                json=request_json(self._use_ferries, source_lon, source_lat, target_lon, target_lat)) as response:
+            return parse_result(await response.json(content_type=None))
+
+
+def request_json(use_ferries, source_lon, source_lat, target_lon, target_lat):
+    json_data = {'locations': [{'lat': source_lat, 'lon': source_lon},
+                               {'lat': target_lat, 'lon': target_lon}],
+                 'costing_options': {
+                   'bicycle': {
+                     'bicycle_type': 'road',
+                   }
+                 },
+                 'costing': 'bicycle'}
+    if not use_ferries:
+        # avoid ferries if configured
+        json_data['costing_options']['bicycle']['use_ferry'] = 0
+    json_data['costing_options']['bicycle']['avoid_bad_surfaces'] = 0.8
+    json_data['costing_options']['bicycle']['use_roads'] = 0.8
+    return json_data
+
+
+def parse_result(result):
+    if 'error' in result:
+        raise RoutingError(result['error'])
+
+    # assumption is, there is only one leg. otherwise we have to handle the result differently
+    assert len(result['trip']['legs']) == 1
+    decoded_route = decode(result['trip']['legs'][0]['shape'])
+    route = shapely.LineString(decoded_route)
+    return int(result['trip']['summary']['time']), float(result['trip']['summary']['length']), route
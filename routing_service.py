@@ -1,6 +1,12 @@
+import asyncio
 import logging
+import math
+import time
+
+import aiohttp
 
 from caching import Cache
+from metrics import Histogram, metrics
 
 
 logger = logging.getLogger(__name__)
@@ -9,12 +15,71 @@ logger = logging.getLogger(__name__)
 DEST_COORDS = (7.44411, 46.9469)
 # two days in seconds
 UNREACHABLE = 172800
+# maximum number of concurrent requests to the routing backend
+CONCURRENT_REQUESTS = 8
+# mean earth radius in meters
+EARTH_RADIUS = 6371000
+# speed in m/s which is never exceeded on average over a whole leg, used to estimate a lower bound for the travel time
+LOWER_BOUND_SPEED = 20
+
+
+def great_circle_distance(source: (float, float), target: (float, float)) -> float:
+    """
+    Calculate the great-circle distance with the haversine formula.
+    :param source: source coordinates: tuple of (lon, lat)
+    :param target: target coordinates: tuple of (lon, lat)
+    :return: the distance in meters
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (source[0], source[1], target[0], target[1]))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def lower_bound_cost(source: (float, float), target: (float, float)) -> int:
+    """
+    Estimate a time for the connection, which is never larger than the routed time.
+    :param source: source coordinates: tuple of (lon, lat)
+    :param target: target coordinates: tuple of (lon, lat)
+    :return: the estimated time in seconds
+    """
+    return int(great_circle_distance(source, target) / LOWER_BOUND_SPEED)
 
 
 class RoutingError(Exception):
     pass
 
 
+class RoutingStatistics:
+    """
+    Counts the cache hits and misses of a routing service and records the latency of the routing backend.
+    """
+    def __init__(self):
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.latencies = Histogram()
+
+    def hit(self):
+        self.cache_hits += 1
+
+    def miss(self, latency):
+        self.cache_misses += 1
+        self.latencies.add(latency)
+
+    def requests(self):
+        return self.cache_hits + self.cache_misses
+
+    def hit_rate(self):
+        return self.cache_hits / self.requests() if self.requests() else 0.0
+
+    def percentile(self, percent):
+        """
+        Approximate latency percentile of the routing backend.
+        :param percent: the percentile between 0 and 100
+        :return: latency in seconds or None, if the backend was never called
+        """
+        return self.latencies.percentile(percent)
+
+
 class RoutingResult:
     def __init__(self, route_key, cache, cost, distance):
         self._route_key = route_key
@@ -28,22 +93,81 @@ class RoutingResult:
     def get_distance(self):
         return self._distance
 
-    def get_route(self):
-        return self._cache.get_file(self._route_key)
+    def get_route_key(self):
+        return self._route_key
+
+    def get_route(self, level=0):
+        """
+        :param level: level of detail, 0 is the full geometry, see caching.ROUTE_TOLERANCES
+        """
+        return self._cache.get_route_file(self._route_key, level)
 
 
 class RoutingService:
-    def __init__(self, cache: Cache, ferries=False, nogos=None):
+    # default address of the routing backend
+    URL = None
+    # maximum number of concurrent requests to the routing backend
+    CONCURRENT_REQUESTS = CONCURRENT_REQUESTS
+    # the backend avoids the nogo cantons, so routes with and without nogos have to be cached separately
+    AVOIDS_NOGOS = False
+    # distance in meters, within which an endpoint reuses the cached routes of a known endpoint in snapping mode
+    SNAP_TOLERANCE = 5
+
+    def __init__(self, cache: Cache, ferries=False, nogos=None, statistics: RoutingStatistics = None, url=None,
+                 session: 'RoutingSession' = None):
+        """
+        :param session: the session shared by the routing services of a sweep, every matrix opens its own client
+        if None
+        """
         self.cache = cache
+        self.url = url or self.URL
         self._use_ferries = ferries
         self.nogos = nogos or []
+        self.statistics = statistics or RoutingStatistics()
+        self.session = session
+
+    @property
+    def cached_nogos(self):
+        """
+        The nogos, which are part of the cache keys: a backend ignoring them returns the same route without them.
+        """
+        return self.nogos if self.AVOIDS_NOGOS else None
 
     def matrix(self, coordinates):
         raise NotImplementedError()
 
+    def _run_concurrently(self, async_backend, call):
+        """
+        Run a call on the asyncio variant of the backend, blocking until it is finished.
+        :param async_backend: the AsyncRoutingService class of the backend
+        :param call: function creating the coroutine from the asyncio routing service
+        """
+        def create(client):
+            return call(async_backend(self.cache, self._use_ferries, self.nogos, self.statistics, self.url,
+                                      client=client))
+
+        if self.session:
+            return self.session.run(create)
+
+        async def run():
+            async with AsyncClient(self.CONCURRENT_REQUESTS) as client:
+                return await create(client)
+
+        return asyncio.run(run())
+
+    def sparse_matrix(self, coordinates, k):
+        """
+        Create a matrix, where only the connections to the k nearest neighbours and the start and end legs are routed.
+        :param coordinates: list of coordinates, the first one is the start
+        :param k: number of nearest neighbours (great-circle distance) to route for every checkpoint
+        :return: tuple of the matrix and the set of (source, target) pairs, which only contain a lower bound estimate
+        """
+        return self._calc_sparse_matrix_from_coordinates(coordinates, k)
+
     def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
         raise NotImplementedError()
 
+    @metrics.timed('routing.cache_or_connection')
     def cache_or_connection(self, source_lon, source_lat, target_lon, target_lat):
         """
         This function returns the shortest distance for the given coordinates.
@@ -65,33 +189,54 @@ class RoutingService:
     #         return time, distance, route
 
         # if there was no previous cache hit, calculate the shortest route
-        route_key = self.cache.get_route_key((source_lon, source_lat), (target_lon, target_lat), self.nogos)
-        if cache_hit := self.cache.get((source_lon, source_lat), (target_lon, target_lat)):
-            (time, distance) = cache_hit
+        route_key = self.cache.get_route_key((source_lon, source_lat), (target_lon, target_lat), self.cached_nogos)
+        if cache_hit := self.cache.get((source_lon, source_lat), (target_lon, target_lat), self.cached_nogos):
+            (cost, distance) = cache_hit
+            self.statistics.hit()
         else:
-            try:
-                (time, distance, route) = self.direct_connection(source_lon, source_lat, target_lon, target_lat)
-                self.cache.set_file(route_key, route)
-            except RoutingError:
-                (time, distance) = UNREACHABLE, None
-            self.cache.set((time, distance), (source_lon, source_lat), (target_lon, target_lat), self.nogos)
+            (cost, distance) = self._connection(route_key, source_lon, source_lat, target_lon, target_lat)
         # if self.nogos:
         #     # save cache for the calculation of routes with cantons to avoid
         #     self.cache.save()
         #     logger.info(
         #         f'calculate route while avoiding cantons '
         #         f'(start: {(source_lat, source_lon)}, dest: {(target_lat, target_lon)})')
-        return RoutingResult(route_key, self.cache, time, distance)
+        return RoutingResult(route_key, self.cache, cost, distance)
 
-    def _calc_matrix_from_coordinates(self, coordinates):
-        result = {}
-        for source in coordinates:
-            if source not in result:
-                result[source] = {}
-            for target in coordinates:
-                if source != target and source != DEST_COORDS:
-                    result[source][target] = self.cache_or_connection(source[0], source[1], target[0], target[1])\
-                        .get_cost()
+    def reroute(self, source_lon, source_lat, target_lon, target_lat):
+        """
+        Route a cached connection again, e.g. because its route file is missing, and replace the cached result.
+        :return: A RoutingResult for the route with the lowest cost
+        """
+        route_key = self.cache.get_route_key((source_lon, source_lat), (target_lon, target_lat), self.cached_nogos)
+        (cost, distance) = self._connection(route_key, source_lon, source_lat, target_lon, target_lat)
+        return RoutingResult(route_key, self.cache, cost, distance)
+
+    def _connection(self, route_key, source_lon, source_lat, target_lon, target_lat):
+        start = time.perf_counter()
+        try:
+            (cost, distance, route) = self.direct_connection(source_lon, source_lat, target_lon, target_lat)
+            self.cache.set_route_file(route_key, route)
+        except RoutingError:
+            (cost, distance) = UNREACHABLE, None
+        self.statistics.miss(time.perf_counter() - start)
+        self.cache.set((cost, distance), (source_lon, source_lat), (target_lon, target_lat), self.cached_nogos)
+        return cost, distance
+
+    @staticmethod
+    def _matrix_pairs(coordinates):
+        return [(source, target) for source in coordinates for target in coordinates
+                if source != target and source != DEST_COORDS]
+
+    def _build_matrix(self, coordinates, costs):
+        """
+        Create the matrix from the costs of the connections.
+        :param coordinates: list of coordinates
+        :param costs: dict of (source, target) pairs to the cost of the connection
+        """
+        result = {source: {} for source in coordinates}
+        for (source, target), cost in costs.items():
+            result[source][target] = cost
 
         # make the time to reach any destination from the final destination Bundesplatz in bern very large, so it will
         # be the final destination for sure
@@ -103,3 +248,175 @@ class RoutingService:
         self.cache.save()
 
         return result
+
+    @staticmethod
+    def candidate_edges(coordinates, k):
+        """
+        Determine the connections which are likely part of an optimal tour.
+        These are the connections to the k nearest neighbours in both directions and every connection from the start
+        or to the final destination.
+        :param coordinates: list of coordinates, the first one is the start
+        :param k: number of nearest neighbours
+        :return: set of (source, target) pairs
+        """
+        start = coordinates[0]
+        candidates = set()
+        for source in coordinates:
+            neighbours = sorted((target for target in coordinates if target != source),
+                                key=lambda target: great_circle_distance(source, target))
+            for target in neighbours[:k]:
+                candidates.add((source, target))
+                candidates.add((target, source))
+        for coordinate in coordinates:
+            if coordinate != start:
+                candidates.add((start, coordinate))
+            if coordinate != DEST_COORDS:
+                candidates.add((coordinate, DEST_COORDS))
+        return candidates
+
+    def _calc_matrix_from_coordinates(self, coordinates):
+        costs = {(source, target): self.cache_or_connection(source[0], source[1], target[0], target[1]).get_cost()
+                 for source, target in self._matrix_pairs(coordinates)}
+        return self._build_matrix(coordinates, costs)
+
+    def _calc_sparse_matrix_from_coordinates(self, coordinates, k):
+        candidates = self.candidate_edges(coordinates, k)
+        costs = {}
+        estimated = set()
+        for source, target in self._matrix_pairs(coordinates):
+            if (source, target) in candidates:
+                costs[source, target] = self.cache_or_connection(source[0], source[1], target[0], target[1])\
+                    .get_cost()
+            else:
+                # the estimate is a lower bound, so the solver is able to verify a tour without this connection
+                costs[source, target] = lower_bound_cost(source, target)
+                estimated.add((source, target))
+        return self._build_matrix(coordinates, costs), estimated
+
+
+class AsyncClient:
+    """
+    HTTP client shared by asyncio routing services. It limits the number of concurrent requests to the routing
+    backend and suppresses duplicate requests, which are in flight at the same time.
+    """
+    def __init__(self, limit=CONCURRENT_REQUESTS):
+        self.limit = asyncio.Semaphore(limit)
+        self.session = None
+        self._in_flight = {}
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    def in_flight(self, key):
+        return key in self._in_flight
+
+    async def deduplicate(self, key, coroutine_function):
+        """
+        Await the result of the coroutine, but share the result with every other caller using the same key while
+        the first call is still running.
+        :param key: identifier of the request, e.g. the route key
+        :param coroutine_function: function without arguments creating the coroutine
+        """
+        if key not in self._in_flight:
+            self._in_flight[key] = asyncio.ensure_future(coroutine_function())
+            self._in_flight[key].add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(self._in_flight[key])
+
+
+class RoutingSession:
+    """
+    Event loop and client shared by the blocking routing services of a sweep, so the connections to the routing
+    backend and the suppression of duplicate requests are reused across the variants.
+    """
+    def __init__(self, limit=CONCURRENT_REQUESTS):
+        self._runner = asyncio.Runner()
+        self._client = AsyncClient(limit)
+
+    def __enter__(self):
+        self._runner.run(self._client.__aenter__())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self._runner.run(self._client.__aexit__(exc_type, exc_val, exc_tb))
+        finally:
+            self._runner.close()
+
+    def run(self, create):
+        """
+        Run a coroutine on the event loop of the session, blocking until it is finished.
+        :param create: function creating the coroutine from the shared AsyncClient
+        """
+        return self._runner.run(create(self._client))
+
+
+class AsyncRoutingService(RoutingService):
+    """
+    asyncio variant of the routing service, the requests to the backend are sent with the shared client.
+    """
+    def __init__(self, cache: Cache, ferries=False, nogos=None, statistics: RoutingStatistics = None, url=None,
+                 client: AsyncClient = None):
+        super().__init__(cache, ferries, nogos, statistics, url)
+        self.client = client
+
+    async def matrix(self, coordinates):
+        return await self._calc_matrix_from_coordinates(coordinates)
+
+    async def sparse_matrix(self, coordinates, k):
+        return await self._calc_sparse_matrix_from_coordinates(coordinates, k)
+
+    async def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
+        raise NotImplementedError()
+
+    @metrics.timed('routing.cache_or_connection')
+    async def cache_or_connection(self, source_lon, source_lat, target_lon, target_lat):
+        """
+        This function returns the shortest distance for the given coordinates.
+        It tries to get the distance from the cache, but calculates it otherwise.
+        :return: A RoutingResult for the route with the lowest cost
+        """
+        route_key = self.cache.get_route_key((source_lon, source_lat), (target_lon, target_lat), self.cached_nogos)
+        if cache_hit := self.cache.get((source_lon, source_lat), (target_lon, target_lat), self.cached_nogos):
+            (cost, distance) = cache_hit
+            self.statistics.hit()
+        else:
+            if self.client.in_flight(route_key):
+                # the result of the identical request is shared, so the backend is not called
+                self.statistics.hit()
+            (cost, distance) = await self.client.deduplicate(
+                route_key, lambda: self._connection(route_key, source_lon, source_lat, target_lon, target_lat))
+        return RoutingResult(route_key, self.cache, cost, distance)
+
+    async def _connection(self, route_key, source_lon, source_lat, target_lon, target_lat):
+        async with self.client.limit:
+            start = time.perf_counter()
+            try:
+                (cost, distance, route) = await self.direct_connection(source_lon, source_lat, target_lon, target_lat)
+                self.cache.set_route_file(route_key, route)
+            except RoutingError:
+                (cost, distance) = UNREACHABLE, None
+            self.statistics.miss(time.perf_counter() - start)
+        self.cache.set((cost, distance), (source_lon, source_lat), (target_lon, target_lat), self.cached_nogos)
+        return cost, distance
+
+    async def _route_pairs(self, pairs):
+        results = await asyncio.gather(
+            *(self.cache_or_connection(source[0], source[1], target[0], target[1]) for source, target in pairs))
+        return {pair: routing_result.get_cost() for pair, routing_result in zip(pairs, results)}
+
+    async def _calc_matrix_from_coordinates(self, coordinates):
+        costs = await self._route_pairs(self._matrix_pairs(coordinates))
+        return self._build_matrix(coordinates, costs)
+
+    async def _calc_sparse_matrix_from_coordinates(self, coordinates, k):
+        candidates = self.candidate_edges(coordinates, k)
+        pairs = self._matrix_pairs(coordinates)
+        routed = await self._route_pairs([pair for pair in pairs if pair in candidates])
+        estimated = {pair for pair in pairs if pair not in candidates}
+        # keep the order of the pairs, the estimates are lower bounds of the routed costs
+        costs = {pair: routed[pair] if pair in routed else lower_bound_cost(*pair) for pair in pairs}
+        return self._build_matrix(coordinates, costs), estimated
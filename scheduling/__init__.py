@@ -0,0 +1,121 @@
+import queue
+from collections import deque
+
+# maximum number of Gurobi threads of a single model, the small TSP models do not scale beyond that
+MAX_THREADS = 4
+# models easier than this fraction of the hardest model are batched into a single job
+SMALL_FRACTION = 0.1
+
+
+def estimate_hardness(matrix):
+    """
+    Estimate how hard the TSP of a distance matrix is to solve. The effort grows with the number of nodes and the gap
+    between a heuristic tour and the lower bound of the root relaxation, which are approximated by the nearest
+    neighbour tour and the sum of the cheapest outgoing connections.
+    :param matrix: distance matrix: dict of coordinates to dict of coordinates to the cost
+    :return: relative hardness, only comparable to the hardness of other matrices
+    """
+    nodes = len(matrix)
+    if nodes < 2:
+        return 0.0
+    lower_bound = sum(min(row.values()) for row in matrix.values() if row)
+
+    start = current = next(iter(matrix))
+    unvisited = set(matrix) - {current}
+    nearest_neighbour = 0
+    while unvisited:
+        reachable = [target for target in matrix[current] if target in unvisited]
+        if not reachable:
+            break
+        target = min(reachable, key=matrix[current].get)
+        nearest_neighbour += matrix[current][target]
+        unvisited.remove(target)
+        current = target
+    nearest_neighbour += matrix[current].get(start, 0)
+
+    gap = (nearest_neighbour - lower_bound) / nearest_neighbour if nearest_neighbour > 0 else 0.0
+    return nodes ** 3 * (1 + max(gap, 0.0))
+
+
+def _run_job(function, arguments, threads):
+    return threads, [function(argument, threads) for argument in arguments]
+
+
+class Scheduler:
+    """
+    Runs tasks of different hardness on a process pool, so the wall-clock time is set by the total work instead of the
+    slowest task. The hardest tasks are started first and every idle process takes the next one. Most tasks run with a
+    single thread, a task which is harder than the remaining work per CPU would be a straggler and gets additional
+    threads, as well as the last tasks, once there are fewer tasks left than free CPUs. Small tasks are batched, so
+    the overhead of the pool does not dominate.
+    """
+    def __init__(self, pool, cpus, max_threads=MAX_THREADS):
+        """
+        :param pool: process pool with at least cpus processes
+        :param cpus: number of CPUs to use, the threads of all running tasks never exceed it
+        :param max_threads: maximum number of threads of a single task
+        """
+        self._pool = pool
+        self._cpus = cpus
+        self._max_threads = max_threads
+
+    def _jobs(self, tasks):
+        """
+        Sort the tasks by descending hardness and batch the small ones.
+        :param tasks: list of tuples of (hardness, argument)
+        :return: list of tuples of (hardness, list of arguments)
+        """
+        tasks = sorted(tasks, key=lambda task: task[0], reverse=True)
+        if not tasks:
+            return []
+        small = tasks[0][0] * SMALL_FRACTION
+        jobs = []
+        batch = []
+        batch_hardness = 0
+        for hardness, argument in tasks:
+            if hardness >= small:
+                jobs.append((hardness, [argument]))
+                continue
+            batch.append(argument)
+            batch_hardness += hardness
+            if batch_hardness >= small:
+                jobs.append((batch_hardness, batch))
+                batch = []
+                batch_hardness = 0
+        if batch:
+            jobs.append((batch_hardness, batch))
+        return jobs
+
+    def run(self, function, tasks):
+        """
+        Run the function for every task.
+        :param function: function of the argument and the number of threads, it has to be picklable
+        :param tasks: list of tuples of (hardness, argument)
+        :return: generator of the results in the order of completion
+        """
+        pending = deque(self._jobs(tasks))
+        remaining = sum(hardness for hardness, _ in pending)
+        finished = queue.Queue()
+        free = self._cpus
+        running = 0
+        while pending or running:
+            while pending and free > 0:
+                hardness, arguments = pending.popleft()
+                # a job harder than the remaining work per CPU would finish last with a single thread
+                threads = int(hardness // (remaining / self._cpus)) if remaining else 1
+                # the tail: the remaining jobs share the spare CPUs
+                if len(pending) < free:
+                    threads = max(threads, free // (len(pending) + 1))
+                threads = max(1, min(threads, self._max_threads, free))
+                remaining -= hardness
+                free -= threads
+                running += 1
+                self._pool.apply_async(_run_job, (function, arguments, threads),
+                                       callback=finished.put, error_callback=finished.put)
+            result = finished.get()
+            running -= 1
+            if isinstance(result, BaseException):
+                raise result
+            threads, results = result
+            free += threads
+            yield from results
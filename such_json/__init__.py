@@ -40,3 +40,16 @@ def dump(obj, fp):
 
 def load(fp):
     return json.load(fp, object_hook=hinted_tuple_hook)
+
+
+def estimated_filename(filename):
+    """
+    Name of the file containing the estimated connections of a sparse distance matrix.
+    :param filename: filename of the distance matrix
+    :return: filename of the estimated connections
+    """
+    return re.sub(r'\.json$', '', filename) + '.estimated'
+
+
+def load_estimated(fp):
+    return {(tuple(source), tuple(target)) for source, target in json.load(fp)}
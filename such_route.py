@@ -1,19 +1,24 @@
 import argparse
 import csv
-import os
-import such_json as json
-
 
 from caching import Cache
-from data import Canton
-from data.scrambling import Scrambler
-from routing.brouter import Brouter
-from routing.valhalla import Valhalla
+from metrics import metrics
+from registry import VALHALLA, backends
+from sweep import SweepRunner, parse_shard
+
 
+def read_checkpoints(filename):
+    checkpoints = []
+    with open(filename, 'r') as csv_file:
+        checkpoint_reader = csv.reader(csv_file, delimiter=';')
+        for i, line in enumerate(checkpoint_reader):
+            if i == 0:
+                continue
+            checkpoints.append(
+                {'longitude': float(line[1]), 'latitude': float(line[0]), 'group': line[2], 'code': line[3],
+                 'canton': line[4], 'station': (float(line[6]), float(line[7])) if line[6] and line[7] else None})
+    return checkpoints
 
-# backends
-BROUTER = 'brouter'
-VALHALLA = 'valhalla'
 
 if __name__ == '__main__':
     '''
@@ -23,44 +28,50 @@ if __name__ == '__main__':
 
     parser.add_argument('-f', '--filename', type=str,
                         help='The checkpoint csv file', required=True)
-    parser.add_argument('-b', '--backend', type=str, choices=[BROUTER, VALHALLA], default=VALHALLA,
+    parser.add_argument('-b', '--backend', type=str, choices=backends.names(), default=VALHALLA,
                         help='The routing backend')
+    parser.add_argument('-k', '--candidates', type=int, default=None,
+                        help='Only route the connections to the k nearest neighbours of every checkpoint and '
+                             'estimate the remaining ones')
+    parser.add_argument('-s', '--shard', type=parse_shard, default=(1, 1),
+                        help='Only calculate the i-th of n shards of the variants, given as i/n')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only recalculate the variants containing checkpoints, which changed since the last run')
+    parser.add_argument('--snap', action='store_true',
+                        help='Reuse the cached routes of endpoints within a few meters of the requested ones')
+    parser.add_argument('-m', '--metrics', type=str, default=None,
+                        help='Record timings of the hot paths and write them to the given JSON file')
+    parser.add_argument('-p', '--profile', type=str, default=None,
+                        help='Profile every phase with cProfile and write it to <PROFILE>-<phase>.prof')
 
     args = parser.parse_args()
 
-    checkpoints = []
+    # shapely and the Overpass client are only imported after the arguments are parsed, so --help starts fast
+    from data import Canton
+    from data.scrambling import Scrambler
 
-    with open(args.filename, 'r') as csv_file:
-        checkpoint_reader = csv.reader(csv_file, delimiter=';')
-        for i, line in enumerate(checkpoint_reader):
-            if i == 0:
-                continue
-            checkpoints.append(
-                {'longitude': float(line[1]), 'latitude': float(line[0]), 'group': line[2], 'code': line[3],
-                 'canton': line[4]})
+    if args.metrics or args.profile:
+        metrics.enable(args.profile)
 
-    if args.backend == BROUTER:
-        routing_backend = Brouter
-    elif args.backend == VALHALLA:
-        routing_backend = Valhalla
-    else:
-        routing_backend = Valhalla
+    checkpoints = read_checkpoints(args.filename)
+    routing_backend = backends.load(args.backend)
 
-    cache = Cache('.such_route_cache', args.backend)
+    cache = Cache('.such_route_cache', args.backend,
+                  snap_tolerance=routing_backend.SNAP_TOLERANCE if args.snap else None)
     cache.load()
 
-    cantons = {i['code']: Canton(i['code'], cache) for i in checkpoints}
+    with metrics.phase('cantons'):
+        cantons = {i['code']: Canton(i['code'], cache) for i in checkpoints}
 
     cache.save()
 
-    for coordinates, nogos in Scrambler(checkpoints, cantons).calc_matrices():
-        routing_service = routing_backend(cache, nogos=nogos)
-        result_matrix = routing_service.matrix(coordinates)
-        if not os.path.exists('results'):
-            os.mkdir('results')
-        nogos_string = ','.join(map(lambda x: x.code, nogos)) if nogos else ''
-        filename = 'distance_matrix.json' if not nogos_string else f'distance_matrix-{nogos_string}.json'
-        with open(f'results/{filename}', "w") as f:
-            json.dump(result_matrix, f)
+    with metrics.phase('variants'):
+        variants = Scrambler(checkpoints, cantons).calc_matrices()
+    with metrics.phase('sweep'):
+        SweepRunner(routing_backend, cache, variants, shard=args.shard, candidates=args.candidates,
+                    checkpoints=checkpoints, incremental=args.incremental).run()
 
-    cache.save()
+    print(f'cache: {cache.hits} hits, {cache.snapped_hits} of them snapped, {cache.misses} misses')
+
+    if args.metrics:
+        metrics.report(args.metrics)
@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import sys
+import time
+from typing import TYPE_CHECKING
+
+import such_json
+from sweep.incremental import CheckpointChanges, checkpoint_snapshot
+
+if TYPE_CHECKING:
+    from routing_service import RoutingStatistics
+
+
+def parse_shard(value):
+    """
+    Parse a shard definition of the form i/n, where i is between 1 and n.
+    :param value: shard definition
+    :return: tuple of (index, count)
+    """
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid shard {value!r}, expected the form i/n, e.g. 1/4')
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'invalid shard {value!r}, expected the form i/n with 1 <= i <= n')
+    return index, count
+
+
+def variant_name(nogos):
+    return ','.join(map(lambda x: x.code, nogos)) if nogos else ''
+
+
+def matrix_filename(nogos):
+    nogos_string = variant_name(nogos)
+    return 'distance_matrix.json' if not nogos_string else f'distance_matrix-{nogos_string}.json'
+
+
+class Manifest:
+    """
+    Keeps track of the finished variants of a sweep, so an interrupted sweep can be resumed.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._done = {}
+        # snapshot of the checkpoints the variants were calculated with
+        self.checkpoints = None
+        # the mode the variants were calculated in: the number of candidates of a sparse matrix, None for a full one
+        self.mode = None
+
+    def load(self):
+        if os.path.exists(self._filename):
+            with open(self._filename, 'r') as f:
+                content = json.load(f)
+            self._done = content['done']
+            self.checkpoints = content.get('checkpoints')
+            self.mode = content.get('mode')
+
+    def save(self):
+        # replace the manifest atomically, an interrupted write must not lose the finished variants
+        temporary_filename = self._filename + '.tmp'
+        with open(temporary_filename, 'w') as f:
+            json.dump({'done': self._done, 'checkpoints': self.checkpoints, 'mode': self.mode}, f)
+        os.replace(temporary_filename, self._filename)
+
+    def is_done(self, variant, directory):
+        """
+        Check if the variant was finished and its result is still present.
+        :param variant: name of the variant
+        :param directory: directory of the results
+        """
+        return variant in self._done and os.path.exists(os.path.join(directory, self._done[variant]))
+
+    def mark_done(self, variant, filename):
+        self._done[variant] = filename
+        self.save()
+
+    def mark_undone(self, variant):
+        """
+        :return: True, if the variant was done
+        """
+        return self._done.pop(variant, None) is not None
+
+    def clear(self):
+        """
+        :return: the number of variants, which were done
+        """
+        done = len(self._done)
+        self._done = {}
+        return done
+
+
+class Progress:
+    """
+    Prints the throughput of a sweep: routed pairs per second, cache hit rate, backend latency and the ETA.
+    """
+    def __init__(self, total, statistics: 'RoutingStatistics', stream=sys.stdout):
+        self._total = total
+        self._statistics = statistics
+        self._stream = stream
+        self._start = time.perf_counter()
+        self._done = 0
+        self._skipped = 0
+
+    def skip(self):
+        self._skipped += 1
+
+    def update(self):
+        self._done += 1
+        elapsed = time.perf_counter() - self._start
+        remaining = self._total - self._done - self._skipped
+        eta = elapsed / self._done * remaining
+        latency = ' '.join(
+            f'p{percent} {self._format_latency(self._statistics.percentile(percent))}' for percent in (50, 90, 99))
+        print(f'[{self._done + self._skipped}/{self._total}] '
+              f'{self._statistics.requests() / elapsed:.1f} pairs/s, '
+              f'cache hits {self._statistics.hit_rate():.1%}, '
+              f'latency {latency}, '
+              f'ETA {time.strftime("%H:%M:%S", time.gmtime(eta))}', file=self._stream, flush=True)
+
+    @staticmethod
+    def _format_latency(latency):
+        return '-' if latency is None else f'{latency:.3f}s'
+
+
+class SweepRunner:
+    """
+    Calculates the distance matrix of every variant, which belongs to the shard and is not finished yet.
+    """
+    def __init__(self, routing_backend, cache, variants, directory='results', shard=(1, 1), candidates=None,
+                 checkpoints=None, incremental=False):
+        """
+        :param routing_backend: class of the routing service
+        :param cache: the cache for the routing service
+        :param variants: list of tuples of (coordinates, nogos), like the output of Scrambler.calc_matrices
+        :param directory: output directory of the distance matrices, nothing is written if None
+        :param shard: tuple of (index, count), only every count-th variant starting with index is calculated
+        :param candidates: number of nearest neighbours for a sparse matrix, calculate a full matrix if None
+        :param checkpoints: the checkpoints of the variants, they are recorded in the manifest
+        :param incremental: only recalculate the variants containing checkpoints, which changed since the last run
+        """
+        self._routing_backend = routing_backend
+        self._cache = cache
+        self._directory = directory
+        self._candidates = candidates
+        self._checkpoints = checkpoint_snapshot(checkpoints) if checkpoints else None
+        self._incremental = incremental
+        index, count = shard
+        self._variants = [variant for i, variant in enumerate(variants) if i % count == index - 1]
+        manifest_filename = 'manifest.json' if count == 1 else f'manifest-{index}-{count}.json'
+        self._manifest = Manifest(os.path.join(directory, manifest_filename)) if directory else None
+        # the routing services are only imported, when a sweep runs
+        from routing_service import RoutingStatistics
+
+        self.statistics = RoutingStatistics()
+        self._session = None
+
+    def run(self, consumer=None):
+        """
+        Calculate the distance matrices.
+        :param consumer: if given, it is called with the nogos, the distance matrix and the estimated connections of
+        every calculated variant
+        """
+        if self._directory and not os.path.exists(self._directory):
+            os.mkdir(self._directory)
+        if self._manifest:
+            self._manifest.load()
+            self._update_mode()
+            if self._checkpoints:
+                self._update_checkpoints()
+        from routing_service import RoutingSession
+
+        progress = Progress(len(self._variants), self.statistics)
+        try:
+            # the connections to the routing backend are kept open for all variants
+            with RoutingSession(self._routing_backend.CONCURRENT_REQUESTS) as self._session:
+                self._calc_variants(progress, consumer)
+        finally:
+            self._session = None
+            # the routed connections since the last saved matrix are not lost on an interruption
+            self._cache.save()
+
+    def _calc_variants(self, progress, consumer):
+        for coordinates, nogos in self._variants:
+            variant = variant_name(nogos)
+            if self._manifest and self._manifest.is_done(variant, self._directory):
+                if consumer:
+                    consumer(nogos, *self._read_variant(nogos))
+                progress.skip()
+                continue
+            result_matrix, estimated = self._calc_variant(coordinates, nogos)
+            if self._manifest:
+                self._manifest.mark_done(variant, self._write_variant(nogos, result_matrix, estimated))
+            if consumer:
+                consumer(nogos, result_matrix, estimated)
+            progress.update()
+
+    def _update_mode(self):
+        """
+        Recalculate every variant, if the variants were calculated with another number of candidates or a full matrix.
+        """
+        mode = {'candidates': self._candidates}
+        if self._manifest.mode != mode:
+            if invalidated := self._manifest.clear():
+                print(f'The candidate mode changed since the last run, recalculating {invalidated} variants')
+            self._manifest.mode = mode
+            self._manifest.save()
+
+    def _update_checkpoints(self):
+        """
+        Remove the cached connections and stations of the checkpoints, which changed since the last run. Only the
+        variants containing them are recalculated in the incremental mode, every variant otherwise.
+        """
+        changes = CheckpointChanges(self._manifest.checkpoints, self._checkpoints)
+        if changes and self._manifest.checkpoints is not None:
+            connections = changes.invalidate(self._cache)
+            self._cache.save()
+            if self._incremental:
+                invalidated = sum(self._manifest.mark_undone(variant_name(nogos))
+                                  for coordinates, nogos in self._variants if changes.affects(coordinates))
+            else:
+                invalidated = self._manifest.clear()
+            print(f'{len(changes.coordinates)} changed coordinates: removed {connections} cached connections, '
+                  f'recalculating {invalidated} variants')
+        self._manifest.checkpoints = self._checkpoints
+        self._manifest.save()
+
+    def _calc_variant(self, coordinates, nogos):
+        """
+        :return: tuple of the distance matrix and the estimated connections or None, if the matrix is complete
+        """
+        routing_service = self._routing_backend(self._cache, nogos=nogos, statistics=self.statistics,
+                                                session=self._session)
+        if self._candidates:
+            return routing_service.sparse_matrix(coordinates, self._candidates)
+        return routing_service.matrix(coordinates), None
+
+    def _read_variant(self, nogos):
+        filename = matrix_filename(nogos)
+        with open(os.path.join(self._directory, filename), 'r') as f:
+            result_matrix = such_json.load(f)
+        estimated = None
+        estimated_filename = os.path.join(self._directory, such_json.estimated_filename(filename))
+        if os.path.exists(estimated_filename):
+            with open(estimated_filename, 'r') as f:
+                estimated = such_json.load_estimated(f)
+        return result_matrix, estimated
+
+    def _write_variant(self, nogos, result_matrix, estimated):
+        filename = matrix_filename(nogos)
+        with open(os.path.join(self._directory, filename), "w") as f:
+            such_json.dump(result_matrix, f)
+        estimated_filename = os.path.join(self._directory, such_json.estimated_filename(filename))
+        if estimated is not None:
+            # the solver needs to know which connections still have to be routed
+            with open(estimated_filename, "w") as f:
+                such_json.dump(sorted(estimated), f)
+        elif os.path.exists(estimated_filename):
+            os.remove(estimated_filename)
+        return filename
@@ -0,0 +1,67 @@
+from typing import Dict, List, Optional, Set, Tuple
+
+
+def checkpoint_snapshot(checkpoints) -> Dict[str, dict]:
+    """
+    Snapshot of the checkpoints, which is stored in the manifest to find the changes of the next run.
+    :param checkpoints: list of dicts with longitude, latitude, group, code and station, like read by such_route.py
+    :return: dict of group:code to the coordinates and the given station of the checkpoint
+    """
+    return {f'{checkpoint["group"]}:{checkpoint["code"]}': {
+        'longitude': checkpoint['longitude'], 'latitude': checkpoint['latitude'],
+        'station': list(checkpoint['station']) if checkpoint.get('station') else None}
+        for checkpoint in checkpoints}
+
+
+class CheckpointChanges:
+    """
+    Differences between the checkpoints of the previous run and the current ones.
+    """
+    def __init__(self, previous: Optional[Dict[str, dict]], current: Dict[str, dict]):
+        previous = previous or {}
+        # coordinates (lon, lat) of the checkpoints, which moved, were added or removed, before and after the change
+        self.coordinates: Set[Tuple[float, float]] = set()
+        # previous checkpoints (lat, lon) and their given station, whose station has to be determined again
+        self.stations: List[Tuple[Tuple[float, float], Optional[Tuple[float, float]]]] = []
+        for name in previous.keys() | current.keys():
+            before, after = previous.get(name), current.get(name)
+            if before == after:
+                continue
+            if before:
+                self.stations.append(((before['latitude'], before['longitude']),
+                                      tuple(before['station']) if before['station'] else None))
+                if after and _same_position(before, after):
+                    # only the station changed, the distance matrices stay the same
+                    continue
+                self.coordinates.add((before['longitude'], before['latitude']))
+            if after:
+                self.coordinates.add((after['longitude'], after['latitude']))
+
+    def __bool__(self):
+        return bool(self.coordinates or self.stations)
+
+    def affects(self, coordinates) -> bool:
+        """
+        :param coordinates: the coordinates of a variant
+        :return: True, if the distance matrix of the variant contains a changed checkpoint
+        """
+        return not self.coordinates.isdisjoint(coordinates)
+
+    def invalidate(self, cache) -> int:
+        """
+        Remove the cached connections and stations of the changed checkpoints, so only their rows and columns of the
+        distance matrices are routed again.
+        :param cache: the cache of the routing service
+        :return: the number of removed connections
+        """
+        for near_point, station in self.stations:
+            # the cost of a station is stored by its position, it belongs to the checkpoint it was determined for
+            position = station or cache.get_generic(cache.station_key(near_point))
+            cache.delete_generic(cache.station_key(near_point))
+            if position:
+                cache.delete_generic(cache.station_cost_key(position))
+        return cache.invalidate(self.coordinates)
+
+
+def _same_position(before, after):
+    return (before['longitude'], before['latitude']) == (after['longitude'], after['latitude'])
@@ -0,0 +1,100 @@
+import os
+import pickle
+
+from caching import VERSION, VERSION_KEY, Cache
+
+
+def test_changes_of_a_copy_are_merged(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'), 'valhalla')
+    cache.load()
+    cache.set((10, 100.0), (7.0, 46.0), (7.1, 46.1))
+
+    # the copy of a worker process only hands over what it routed itself
+    cache.track_changes()
+    cache.set((20, 200.0), (7.1, 46.1), (7.2, 46.2))
+    changes = cache.pop_changes()
+    assert list(changes.values()) == [(20, 200.0)]
+    assert cache.pop_changes() == {}
+
+    parent = Cache(str(tmp_path / 'cache'), 'valhalla')
+    parent.load()
+    parent.update(changes)
+    assert parent.get((7.1, 46.1), (7.2, 46.2)) == (20, 200.0)
+
+
+def test_changes_are_not_tracked_by_default(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'), 'valhalla')
+    cache.load()
+    cache.set((10, 100.0), (7.0, 46.0), (7.1, 46.1))
+    assert cache.pop_changes() == {}
+
+
+class FakeCanton:
+    def __init__(self, code):
+        self.code = code
+
+
+def old_cache(tmp_path, entries, files):
+    """A cache written before the coordinates were quantized, without a version."""
+    with open(tmp_path / 'cache', 'wb') as f:
+        pickle.dump(entries, f)
+    os.mkdir(tmp_path / 'cache_files')
+    for filename in files:
+        with open(tmp_path / 'cache_files' / filename, 'wb') as f:
+            pickle.dump(filename, f)
+    cache = Cache(str(tmp_path / 'cache'), 'valhalla')
+    cache.load()
+    return cache
+
+
+def test_old_keys_are_migrated(tmp_path):
+    cache = old_cache(tmp_path, {
+        'valhalla:(7.0, 46.0):(7.1, 46.1)': (10, 100.0),
+        'valhalla:(7.0, 46.0):(7.1, 46.1)CH-BE,CH-ZH': (20, 200.0),
+        'station:46.9,7.4': 'station',
+        'station_cost:46.9,7.4': 30,
+    }, ['valhalla:(7.0, 46.0):(7.1, 46.1):route', 'valhalla:(7.0, 46.0):(7.1, 46.1)CH-BE:route:lod2'])
+
+    assert cache.get((7.0, 46.0), (7.1, 46.1)) == (10, 100.0)
+    assert cache.get((7.0, 46.0), (7.1, 46.1), [FakeCanton('CH-BE'), FakeCanton('CH-ZH')]) == (20, 200.0)
+    assert cache.get_generic(cache.station_key((46.9, 7.4))) == 'station'
+    assert cache.get_generic(cache.station_cost_key((46.9, 7.4))) == 30
+    route_key = cache.get_route_key((7.0, 46.0), (7.1, 46.1))
+    assert cache.get_file(route_key) == 'valhalla:(7.0, 46.0):(7.1, 46.1):route'
+    nogo_route_key = cache.get_route_key((7.0, 46.0), (7.1, 46.1), [FakeCanton('CH-BE')])
+    assert cache.get_file(f'{nogo_route_key}:lod2') == 'valhalla:(7.0, 46.0):(7.1, 46.1)CH-BE:route:lod2'
+    assert sorted(os.listdir(tmp_path / 'cache_files')) == sorted([route_key, f'{nogo_route_key}:lod2'])
+
+    # the version is saved with the migrated keys
+    cache.save()
+    reloaded = Cache(str(tmp_path / 'cache'), 'valhalla')
+    reloaded.load()
+    assert dict(reloaded.items()) == dict(cache.items())
+    assert dict(cache.items())[VERSION_KEY] == VERSION
+
+
+def test_snapped_hits_are_counted(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'), 'valhalla', snap_tolerance=10)
+    cache.load()
+    cache.set((10, 100.0), (7.0, 46.0), (7.1, 46.1))
+
+    # about 5m away from both endpoints
+    assert cache.get((7.0, 46.00005), (7.1, 46.10005)) == (10, 100.0)
+    assert cache.get((7.0, 46.0), (7.1, 46.1)) == (10, 100.0)
+    # about 50m away
+    assert cache.get((7.0, 46.0005), (7.1, 46.1)) is None
+    assert (cache.hits, cache.snapped_hits, cache.misses) == (2, 1, 1)
+
+
+def test_endpoints_are_snapped_after_reload(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'), 'valhalla', snap_tolerance=10)
+    cache.load()
+    cache.set((10, 100.0), (7.0, 46.0), (7.1, 46.1))
+    cache.set((20, 200.0), (7.0, 46.0), (7.1, 46.1), [FakeCanton('CH-BE')])
+    cache.save()
+
+    reloaded = Cache(str(tmp_path / 'cache'), 'valhalla', snap_tolerance=10)
+    reloaded.load()
+    assert reloaded.get((7.00005, 46.0), (7.1, 46.10005)) == (10, 100.0)
+    assert reloaded.get((7.00005, 46.0), (7.1, 46.10005), [FakeCanton('CH-BE')]) == (20, 200.0)
+    assert reloaded.snapped_hits == 2
@@ -0,0 +1,26 @@
+import numpy as np
+import shapely
+from shapely import LineString, Point
+
+from caching import Cache
+from data import Canton
+
+TOLERANCE = 0.001
+
+
+def test_coarse_intersection_matches_the_full_route(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'), 'valhalla')
+    cache.set_generic('CH-XX', Point(7.0, 46.0).buffer(0.1))
+    canton = Canton('CH-XX', cache)
+
+    random = np.random.default_rng(0)
+    for _ in range(200):
+        # routes ending around the border, some of them only touch the canton between the points of the coarse route
+        start = random.uniform((6.7, 45.7), (7.3, 46.3))
+        points = start + np.cumsum(random.normal(0, 0.002, (300, 2)), axis=0)
+        route = LineString(points)
+        coarse = route.simplify(TOLERANCE, preserve_topology=True)
+        loaded = []
+        intersects = canton.intersect(coarse, TOLERANCE, lambda: loaded.append(route) or route)
+        assert intersects == shapely.intersects(route, canton.polygon)
+        assert not loaded or shapely.dwithin(route, canton.polygon.exterior, 4 * TOLERANCE)
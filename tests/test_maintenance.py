@@ -0,0 +1,74 @@
+import os
+
+from caching import Cache
+from caching.maintenance import PREFER_SOURCE, PREFER_TARGET, compact, evict, merge
+
+START = (7.0, 46.0)
+DEST = (7.1, 46.1)
+
+
+def cache_with_route(filename, value, route):
+    cache = Cache(filename, 'valhalla')
+    cache.load()
+    cache.set(value, START, DEST)
+    cache.set_file(cache.get_route_key(START, DEST), route)
+    cache.save()
+    return cache
+
+
+def route_of(cache):
+    return cache.get_file(cache.get_route_key(START, DEST))
+
+
+def test_merge_conflict_keeps_the_preferred_value_and_its_route(tmp_path):
+    source = str(tmp_path / 'source')
+    cache_with_route(source, (20, 200.0), 'source route')
+
+    target = cache_with_route(str(tmp_path / 'target'), (10, 100.0), 'target route')
+    assert merge(target, [source], prefer=PREFER_TARGET) == {'entries': 0, 'conflicts': 1, 'files': 0}
+    assert (target.get(START, DEST), route_of(target)) == ((10, 100.0), 'target route')
+
+    assert merge(target, [source], prefer=PREFER_SOURCE) == {'entries': 1, 'conflicts': 1, 'files': 1}
+    assert (target.get(START, DEST), route_of(target)) == ((20, 200.0), 'source route')
+
+
+def test_merge_copies_the_missing_route_of_an_identical_connection(tmp_path):
+    source = str(tmp_path / 'source')
+    cache_with_route(source, (10, 100.0), 'route')
+
+    target = cache_with_route(str(tmp_path / 'target'), (10, 100.0), 'route')
+    os.remove(os.path.join(target.dirname, target.get_route_key(START, DEST)))
+    assert merge(target, [source]) == {'entries': 0, 'conflicts': 0, 'files': 1}
+    assert route_of(target) == 'route'
+    # an existing route file is kept
+    assert merge(target, [source])['files'] == 0
+
+
+def test_compact_removes_unreadable_files(tmp_path):
+    cache = cache_with_route(str(tmp_path / 'cache'), (10, 100.0), 'route')
+    route_key = cache.get_route_key(START, DEST)
+    with open(os.path.join(cache.dirname, route_key), 'wb') as f:
+        # a pickle of a class, which does not exist
+        f.write(b'cbuiltins\nmissing\n.')
+    result = compact(cache)
+    assert result['orphaned'] == 0
+    assert list(result['unreadable']) == [route_key]
+    assert 'AttributeError' in result['unreadable'][route_key]
+    assert not os.path.exists(os.path.join(cache.dirname, route_key))
+
+
+def test_evict_removes_the_connection_of_a_route(tmp_path):
+    cache = cache_with_route(str(tmp_path / 'cache'), (10, 100.0), 'route')
+    other = (7.2, 46.2)
+    cache.set((20, 200.0), START, other)
+    cache.set_file(cache.get_route_key(START, other), 'other route')
+    # the other route was used more recently
+    cache.get_file(cache.get_route_key(START, other))
+
+    budget = os.path.getsize(os.path.join(cache.dirname, cache.get_route_key(START, other)))
+    assert evict(cache, budget) > 0
+    # the connection is routed again, instead of having no route
+    assert cache.get(START, DEST) is None
+    assert route_of(cache) is None
+    assert cache.get(START, other) == (20, 200.0)
+    assert cache.get_file(cache.get_route_key(START, other)) == 'other route'
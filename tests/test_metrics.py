@@ -0,0 +1,43 @@
+import multiprocessing
+
+import pytest
+
+import tsp_solver
+from caching import Cache
+from metrics import metrics
+
+
+class FakeVariantSolver:
+    def __init__(self, cache):
+        self.cache = cache
+
+
+def count_in_worker(_):
+    with metrics.phase('worker'):
+        metrics.count('counter')
+    return metrics.snapshot()
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.enable()
+    metrics.reset()
+    yield metrics
+    metrics.reset()
+    metrics.enabled = False
+
+
+def test_worker_snapshot_does_not_repeat_the_counts_of_the_parent(enabled_metrics, tmp_path):
+    cache = Cache(str(tmp_path / 'cache'), 'valhalla')
+    metrics.count('counter')
+    with metrics.phase('stations'):
+        pass
+
+    with multiprocessing.get_context('fork').Pool(
+            1, initializer=tsp_solver.init_worker, initargs=(FakeVariantSolver(cache),)) as pool:
+        snapshot = pool.apply(count_in_worker, (None,))
+    metrics.merge(snapshot)
+
+    assert metrics.counters['counter'] == 2
+    assert metrics.timings['phase.stations'].count == 1
+    assert metrics.timings['phase.worker'].count == 1
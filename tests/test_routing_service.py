@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from caching import Cache
+from routing_service import DEST_COORDS, AsyncClient, AsyncRoutingService, RoutingService, RoutingSession, RoutingStatistics
+
+SOURCE = (7.0, 46.0)
+# the matrix needs the final destination
+TARGET = DEST_COORDS
+
+
+class SlowAsyncRouting(AsyncRoutingService):
+    calls = 0
+
+    async def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
+        SlowAsyncRouting.calls += 1
+        await asyncio.sleep(0.01)
+        return 100, 1000.0, None
+
+
+class SlowRouting(RoutingService):
+    clients = []
+
+    def matrix(self, coordinates):
+        async def route(routing_service):
+            SlowRouting.clients.append(routing_service.client)
+            return await routing_service.matrix(coordinates)
+
+        return self._run_concurrently(SlowAsyncRouting, route)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    SlowAsyncRouting.calls = 0
+    SlowRouting.clients = []
+    cache = Cache(str(tmp_path / 'cache'), 'slow')
+    cache.load()
+    # the fake routes have no geometry
+    monkeypatch.setattr(cache, 'set_route_file', lambda route_key, route: None)
+    return cache
+
+
+def test_deduplicated_requests_are_hits(cache):
+    statistics = RoutingStatistics()
+
+    async def route_twice():
+        async with AsyncClient() as client:
+            routing_service = SlowAsyncRouting(cache, statistics=statistics, client=client)
+            return await asyncio.gather(*(routing_service.cache_or_connection(*SOURCE, *TARGET) for _ in range(2)))
+
+    results = asyncio.run(route_twice())
+    assert [result.get_cost() for result in results] == [100, 100]
+    assert SlowAsyncRouting.calls == 1
+    assert (statistics.cache_hits, statistics.cache_misses) == (1, 1)
+
+
+def test_session_shares_the_client(cache):
+    with RoutingSession() as session:
+        SlowRouting(cache, session=session).matrix([SOURCE, TARGET])
+        SlowRouting(cache, session=session).matrix([SOURCE, TARGET])
+    assert len(SlowRouting.clients) == 2 and SlowRouting.clients[0] is SlowRouting.clients[1]
+    # the second matrix is served by the cache, there is no connection from the final destination
+    assert SlowAsyncRouting.calls == 1
+
+
+class Canton:
+    def __init__(self, code):
+        self.code = code
+
+
+class CountingRouting(RoutingService):
+    calls = 0
+
+    def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
+        CountingRouting.calls += 1
+        return 100, 1000.0, None
+
+
+@pytest.mark.parametrize('avoids_nogos, calls', [(False, 1), (True, 2)])
+def test_nogos_are_only_part_of_the_key_if_the_backend_avoids_them(cache, avoids_nogos, calls):
+    CountingRouting.calls = 0
+    CountingRouting.AVOIDS_NOGOS = avoids_nogos
+    CountingRouting(cache, nogos=[Canton('CH-ZH')]).cache_or_connection(*SOURCE, *TARGET)
+    # a backend ignoring the nogos returns the same route in every variant
+    for nogos in ([Canton('CH-ZH')], []):
+        CountingRouting(cache, nogos=nogos).cache_or_connection(*SOURCE, *TARGET)
+    assert CountingRouting.calls == calls
+
+
+def test_async_connections_are_timed(cache):
+    from metrics import metrics
+
+    metrics.enable()
+    metrics.reset()
+    try:
+        SlowRouting(cache).matrix([SOURCE, TARGET])
+        assert metrics.timings['routing.cache_or_connection'].count == 1
+    finally:
+        metrics.reset()
+        metrics.enabled = False
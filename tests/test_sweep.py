@@ -0,0 +1,100 @@
+import argparse
+
+import pytest
+
+from caching import Cache
+from sweep import SweepRunner, parse_shard
+
+START = (7.0, 46.0)
+CHECKPOINT = (7.1, 46.1)
+OTHER = (7.3, 46.3)
+
+
+class FakeRouting:
+    """
+    Routing backend, which routes every connection with the distance in micro-degrees and caches it.
+    """
+    CONCURRENT_REQUESTS = 1
+    requested = []
+
+    def __init__(self, cache, nogos=None, statistics=None, **kwargs):
+        self.cache = cache
+
+    def _cost(self, source, target):
+        if cached := self.cache.get(source, target):
+            return cached[0]
+        FakeRouting.requested.append((source, target))
+        cost = round(abs(source[0] - target[0]) * 1e6 + abs(source[1] - target[1]) * 1e6)
+        self.cache.set((cost, float(cost)), source, target)
+        return cost
+
+    def matrix(self, coordinates):
+        return {source: {target: self._cost(source, target) for target in coordinates if target != source}
+                for source in coordinates}
+
+    def sparse_matrix(self, coordinates, k):
+        return self.matrix(coordinates), set()
+
+
+class Nogo:
+    def __init__(self, code):
+        self.code = code
+
+
+@pytest.fixture
+def cache(tmp_path):
+    FakeRouting.requested = []
+    cache = Cache(str(tmp_path / 'cache'), 'fake')
+    cache.load()
+    return cache
+
+
+def sweep(cache, directory, variants, **kwargs):
+    matrices = []
+    SweepRunner(FakeRouting, cache, variants, directory=str(directory), **kwargs).run(
+        lambda nogos, result_matrix, estimated: matrices.append(result_matrix))
+    return matrices
+
+
+def test_parse_shard():
+    assert parse_shard('2/4') == (2, 4)
+    for value in ('2', 'a/b', '0/4', '5/4'):
+        with pytest.raises(argparse.ArgumentTypeError, match='i/n'):
+            parse_shard(value)
+
+
+def test_changed_candidate_mode_recalculates_the_variants(cache, tmp_path):
+    variants = [([START, CHECKPOINT], [])]
+    sweep(cache, tmp_path / 'results', variants)
+    # the finished variants are skipped in the same mode
+    sweep(cache, tmp_path / 'results', variants)
+    assert len(FakeRouting.requested) == 2
+    # a cleared cache shows, whether the variants are calculated again
+    cache.invalidate([START, CHECKPOINT])
+    sweep(cache, tmp_path / 'results', variants, candidates=3)
+    assert len(FakeRouting.requested) == 4
+
+
+def checkpoint(coordinates, code):
+    return {'longitude': coordinates[0], 'latitude': coordinates[1], 'group': '1', 'code': code, 'station': None}
+
+
+def test_changed_checkpoints_recalculate_the_variants(cache, tmp_path):
+    moved = (7.2, 46.2)
+    other = ([START, OTHER], [Nogo('CH-ZH')])
+    directory = tmp_path / 'results'
+    sweep(cache, directory, [([START, CHECKPOINT], []), other],
+          checkpoints=[checkpoint(START, 'CH-BE'), checkpoint(CHECKPOINT, 'CH-ZH'), checkpoint(OTHER, 'CH-LU')])
+
+    checkpoints = [checkpoint(START, 'CH-BE'), checkpoint(moved, 'CH-ZH'), checkpoint(OTHER, 'CH-LU')]
+    # without the incremental mode, every variant is recalculated
+    matrices = sweep(cache, directory, [([START, moved], []), other], checkpoints=checkpoints)
+    assert set(matrices[0]) == {START, moved}
+    assert FakeRouting.requested[-2:] == [(START, moved), (moved, START)]
+    assert len(FakeRouting.requested) == 6
+
+    moved_back = [checkpoint(START, 'CH-BE'), checkpoint(CHECKPOINT, 'CH-ZH'), checkpoint(OTHER, 'CH-LU')]
+    matrices = sweep(cache, directory, [([START, CHECKPOINT], []), other], checkpoints=moved_back, incremental=True)
+    assert set(matrices[0]) == {START, CHECKPOINT}
+    # only the variant of the changed checkpoint is routed, its connections were removed from the cache
+    assert FakeRouting.requested[6:] == [(START, CHECKPOINT), (CHECKPOINT, START)]
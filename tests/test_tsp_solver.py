@@ -0,0 +1,143 @@
+import os
+from itertools import permutations, product
+
+import pandas as pd
+import pytest
+from shapely.geometry import LineString, box
+
+from caching import Cache
+from routing_service import DEST_COORDS, RoutingService
+from tsp_solver import MANDATORY_GROUPS, CheckpointIndex, GroupTspSolver, VariantSolver
+
+pytest.importorskip('gurobipy')
+
+# (lon, lat), group and code, B is on the straight route from A to E
+CHECKPOINTS = [
+    (DEST_COORDS, 0, 'CH-BE'),
+    ((7.50, 46.95), 1, 'CH-AA'),
+    ((7.60, 46.95), 1, 'CH-BB'),
+    ((7.55, 47.00), 2, 'CH-CC'),
+    ((7.65, 47.05), 2, 'CH-DD'),
+    ((7.70, 46.95), 8, 'CH-EE'),
+]
+
+
+class StraightRouting(RoutingService):
+    """Routes straight lines, the cost is the length in micro-degrees."""
+    def matrix(self, coordinates):
+        return self._calc_matrix_from_coordinates(coordinates)
+
+    def sparse_matrix(self, coordinates, k):
+        return self._calc_sparse_matrix_from_coordinates(coordinates, k)
+
+    def direct_connection(self, source_lon, source_lat, target_lon, target_lat):
+        route = LineString([(source_lon, source_lat), (target_lon, target_lat)])
+        return round(route.length * 1e5), route.length, route
+
+
+class FakeCanton:
+    """A small square around the checkpoint."""
+    def __init__(self, coordinates):
+        self.polygon = box(coordinates[0] - 0.01, coordinates[1] - 0.01, coordinates[0] + 0.01, coordinates[1] + 0.01)
+
+    def intersect(self, polyline, tolerance=0.0, full_route=None):
+        return bool(self.polygon.intersects(polyline))
+
+
+class FakeStation:
+    def __init__(self, cost):
+        self.cost = cost
+
+    def get_cost(self):
+        return self.cost
+
+
+@pytest.fixture
+def problem(tmp_path, monkeypatch):
+    # the solver writes its log to the working directory
+    monkeypatch.chdir(tmp_path)
+    data = pd.DataFrame({'Longitude': [point[0] for point, _, _ in CHECKPOINTS],
+                         'Latitude': [point[1] for point, _, _ in CHECKPOINTS],
+                         'Group': [group for _, group, _ in CHECKPOINTS],
+                         'Code': [code for _, _, code in CHECKPOINTS]})
+    # the tour starts at A, the cheapest one skips B and goes straight to E, unless the route avoids B
+    stations = {(lat, lon): FakeStation(0 if row == 1 else 100000) for row, (lon, lat) in
+                enumerate(zip(data['Longitude'], data['Latitude']))}
+    cache = Cache('cache', 'straight')
+    cache.load()
+    matrix = StraightRouting(cache).matrix([point for point, _, _ in CHECKPOINTS])
+    cantons = {code: FakeCanton(point) for point, _, code in CHECKPOINTS}
+    return cache, data, stations, matrix, cantons
+
+
+def brute_force(data, stations, matrix, cantons):
+    """The cheapest tour over every choice of the skipped checkpoints and every order."""
+    points = {row: (lon, lat) for row, lon, lat in zip(data.index, data['Longitude'], data['Latitude'])}
+    groups = {}
+    for row, group in zip(data.index, data['Group']):
+        groups.setdefault(group, []).append(row)
+    optional = [members for group, members in groups.items() if group not in MANDATORY_GROUPS]
+    final = next(row for row, point in points.items() if point == DEST_COORDS)
+    best = None
+    for skipped in product(*optional):
+        avoided = [cantons[data.loc[row, 'Code']] for row in skipped]
+        visited = [row for row in points if row not in skipped and row != final]
+        for order in permutations(visited):
+            tour = list(order) + [final]
+            legs = list(zip(tour, tour[1:]))
+            if any(canton.intersect(LineString([points[i], points[j]])) for i, j in legs for canton in avoided):
+                continue
+            lon, lat = points[tour[0]]
+            cost = stations[(lat, lon)].get_cost() + sum(matrix[points[i]][points[j]] for i, j in legs)
+            best = cost if best is None else min(best, cost)
+    return best
+
+
+def remove_routes(cache, source):
+    """Delete every route file from the source, e.g. evicted or lost in a merge."""
+    prefix = cache.get_route_key(source, DEST_COORDS).split(':')[:2]
+    directory = 'cache_files'
+    for filename in os.listdir(directory):
+        if filename.split(':')[:2] == prefix:
+            os.remove(os.path.join(directory, filename))
+
+
+def test_generalized_tour_is_the_cheapest_variant(problem):
+    cache, data, stations, matrix, cantons = problem
+    solver = GroupTspSolver(cache, stations, data, matrix, cantons=cantons,
+                            index=CheckpointIndex(data, stations))
+    _, cost = solver.solve()
+    assert cost == pytest.approx(brute_force(data, stations, matrix, cantons))
+
+
+def test_missing_routes_are_routed_again(problem):
+    cache, data, stations, matrix, cantons = problem
+    remove_routes(cache, CHECKPOINTS[1][0])
+    routing_service = StraightRouting(cache)
+    solver = GroupTspSolver(cache, stations, data, matrix, cantons=cantons, routing_service=routing_service,
+                            index=CheckpointIndex(data, stations))
+    _, cost = solver.solve()
+    assert routing_service.statistics.cache_misses == len(CHECKPOINTS) - 1
+    assert cost == pytest.approx(brute_force(data, stations, matrix, cantons))
+
+
+def test_missing_routes_require_a_routing_service(problem):
+    cache, data, stations, matrix, cantons = problem
+    remove_routes(cache, CHECKPOINTS[1][0])
+    with pytest.raises(ValueError, match='missing'):
+        GroupTspSolver(cache, stations, data, matrix, cantons=cantons, index=CheckpointIndex(data, stations))
+
+
+def test_variant_refined_by_the_caller_is_optimal(problem):
+    cache, data, stations, matrix, _ = problem
+    sparse_cache = Cache('sparse', 'straight')
+    sparse_cache.load()
+    sparse, estimated = StraightRouting(sparse_cache).sparse_matrix([point for point, _, _ in CHECKPOINTS], 1)
+    assert estimated
+    variant_solver = VariantSolver(data, sparse_cache, stations, StraightRouting)
+    while True:
+        cost, tour = variant_solver.solve(sparse, estimated, refine=False)
+        if not (refined := variant_solver.refine(sparse, estimated, tour)):
+            break
+        sparse, estimated = refined
+    assert cost == pytest.approx(VariantSolver(data, cache, stations, StraightRouting).solve(matrix)[0])
@@ -1,84 +1,110 @@
-import copy
+import argparse
+import functools
 import logging
 import math
 import multiprocessing
 import os
+import re
 
 from collections import defaultdict
 
 from itertools import permutations
-import pandas as pd
 import such_json as json
 
-import gurobipy as gp
-from gurobipy import GRB
-
-from data.station import NearestStation
-from caching import Cache
+from caching import COARSE_LEVEL, ROUTE_TOLERANCES, Cache
+from caching.memo import TourMemo, matrix_hash
+from metrics import metrics
+from registry import VALHALLA, backends
+from scheduling import Scheduler, estimate_hardness
 
 FINAL_DESTINATION = (7.44411, 46.9469)
 INDEX_OF_ARTIFICAL_NODE = 99
+# position of the artificial node in the augmented distance matrix
+POSITION_OF_ARTIFICAL_NODE = 0
+# groups of checkpoints which have to be visited completely, the final destination and Jura
+MANDATORY_GROUPS = (0, 8)
+
+
+class CheckpointIndex:
+    """
+    Index of all checkpoints, which is built once and shared by the solvers of every variant.
+    It maps the coordinates to the row of the checkpoint and the row to the cost to reach it from the nearest station.
+    """
+    def __init__(self, data, stations=None):
+        self.rows = {}
+        for row, lon, lat in zip(data.index, data['Longitude'], data['Latitude']):
+            self.rows.setdefault((lon, lat), int(row))
+        self.station_costs = {int(row): stations[(lat, lon)].get_cost()
+                              for row, lon, lat in zip(data.index, data['Longitude'], data['Latitude'])}\
+            if stations else {}
 
 
 class TspSolver:
-    def __init__(self, cache, stations, data, importedDistance, euclidean=False):
+    def __init__(self, cache, stations, data, importedDistance, euclidean=False, routing_service=None,
+                 estimated=None, index: CheckpointIndex = None, threads=1):
         self.euclidean = euclidean
-        # Extract latitude, longitude, and Canton information
+        # number of Gurobi threads, the variants are usually solved in parallel processes with a single thread each
+        self.threads = threads
+        self.index = index or CheckpointIndex(data, stations if not euclidean else None)
+        # connections of a sparse matrix, which only contain a lower bound and are routed on demand
+        self.routing_service = routing_service
+        self.estimated = set(estimated) if estimated else set()
         self.data = data
         self.cache = cache
         self.stations = stations
-        self.latitudes = data['Latitude']
-        self.longitudes = data['Longitude']
-        self.cantons = data['Canton']
         self.rearranged_tour = None
-        self.cost = {}
 
         self._coordinates = list(importedDistance.keys())
         self.checkpoints = self.determine_checkpoints_to_visit()
+        # the nodes in the order of their position in the distance matrix, the artificial node comes first
         self.nodes = [INDEX_OF_ARTIFICAL_NODE] + list(self.checkpoints.keys())
+        self.positions = {node: position for position, node in enumerate(self.nodes)}
         # Retrieve the first key matching the value, or None if not found
         self.index_of_final_destination = next(
             (key for key, value in self.checkpoints.items() if value == FINAL_DESTINATION), None)
         self.distances = self.augment_distance(importedDistance)
-        self.model = gp.Model()
+        # cost to reach each node from its nearest station
+        self.cost = self.distances[POSITION_OF_ARTIFICAL_NODE]
+
+    # Extract latitude, longitude, and Canton information on demand, the columns are not needed to solve the tour
+    @property
+    def latitudes(self):
+        return self.data['Latitude']
+
+    @property
+    def longitudes(self):
+        return self.data['Longitude']
+
+    @property
+    def cantons(self):
+        return self.data['Canton']
 
     def determine_checkpoints_to_visit(self):
-        checkpoints = {}
-        for lon, lat in self._coordinates:
-            match = self.data[(self.data['Longitude'] == lon) & (
-                self.data['Latitude'] == lat)]
-            if not match.empty:
-                checkpoints[int(match.index[0])] = (lon, lat)
-        return checkpoints
+        return {self.index.rows[coordinates]: coordinates for coordinates in self._coordinates
+                if coordinates in self.index.rows and self.index.rows[coordinates] in self.data.index}
 
     def augment_distance(self, distances):
         """Augment the distance matrix with a dummy node to handle the TSP with
-        a fixed starting point (0) and ending point (n-1)."""
-
-        augmented_distance = {}
-        for node_i in self.nodes:
-            for node_j in self.nodes:
-                if node_i == INDEX_OF_ARTIFICAL_NODE or node_j == INDEX_OF_ARTIFICAL_NODE or node_i == node_j:
-                    augmented_distance[node_i, node_j] = 0
-                    continue
-                pointI = self.checkpoints[node_i]
-                pointJ = self.checkpoints[node_j]
-                if self.euclidean:
-                    # Calculate Euclidean distance
-                    augmented_distance[node_i, node_j] = math.sqrt(
-                        (pointJ[0] - pointI[0]) ** 2 + (pointJ[1] - pointI[1]) ** 2)
-                    continue
-                augmented_distance[node_i, node_j] = distances[pointI][pointJ]
-
-        # Add the cost to the nearest station for each checkpoint
-        # save the cost to the nearest station in the last element of the tuple of each checkpoint (self.checkpoints)
-        if not self.euclidean:
-            for i in self.nodes:
-                if i == INDEX_OF_ARTIFICAL_NODE or i == self.index_of_final_destination:
-                    continue
-                lon, lat = self.checkpoints[i]
-                augmented_distance[INDEX_OF_ARTIFICAL_NODE, i] = self.stations[(lat, lon)].get_cost()
-                self.cost[i] = augmented_distance[INDEX_OF_ARTIFICAL_NODE, i]
+        a fixed starting point (0) and ending point (n-1).
+        The result is a matrix indexed by the positions of the nodes."""
+        import numpy as np
+
+        points = [self.checkpoints[node] for node in self.nodes[1:]]
+        augmented_distance = np.zeros((len(self.nodes), len(self.nodes)))
+        if self.euclidean:
+            # Calculate Euclidean distance
+            coordinates = np.array(points)
+            augmented_distance[1:, 1:] = np.sqrt(
+                ((coordinates[np.newaxis, :, :] - coordinates[:, np.newaxis, :]) ** 2).sum(axis=2))
+            return augmented_distance
+        augmented_distance[1:, 1:] = [[distances[point_i][point_j] if point_i != point_j else 0 for point_j in points]
+                                      for point_i in points]
+
+        # Add the cost to the nearest station for each checkpoint, the final destination is never the first one
+        augmented_distance[POSITION_OF_ARTIFICAL_NODE, 1:] = [self.index.station_costs[node]
+                                                              for node in self.nodes[1:]]
+        if self.index_of_final_destination is not None:
+            augmented_distance[POSITION_OF_ARTIFICAL_NODE, self.positions[self.index_of_final_destination]] = 0
         return augmented_distance
 
     class _tspCallback:
@@ -86,15 +112,22 @@ class TspSolver:
         callbacks, solutions are checked for subtours and subtour elimination
         constraints are added if needed."""
 
-        def __init__(self, nodes, x):
+        def __init__(self, nodes, x, visited=None):
+            import gurobipy as gp
+
             self.nodes = nodes
             self.x = x
+            # number of nodes in a complete tour
+            self.visited = visited or len(nodes)
+            # resolved once, the callback is called for every solution
+            self._mipsol = gp.GRB.Callback.MIPSOL
+            self._quicksum = gp.quicksum
 
         def __call__(self, model, where):
             """Callback entry point: call lazy constraints routine when new
             solutions are found. Stop the optimization if there is an exception in
             user code."""
-            if where == GRB.Callback.MIPSOL:
+            if where == self._mipsol:
                 try:
                     self.eliminate_subtours(model)
                 except Exception:
@@ -140,14 +173,63 @@ class TspSolver:
             values = model.cbGetSolution(self.x)
             edges = [(i, j) for (i, j), v in values.items() if v > 0.5]
             tour = self.shortest_subtour(edges)
-            if len(tour) < len(self.nodes):
+            if len(tour) < self.visited:
                 # add subtour elimination constraint for every pair of cities in tour
                 model.cbLazy(
-                    gp.quicksum(self.x[i, j] for i, j in permutations(tour, 2))
+                    self._quicksum(self.x[i, j] for i, j in permutations(tour, 2))
                     <= len(tour) - 1
                 )
 
-    def solve(self):
+    def refine(self, tour):
+        """
+        Replace the estimated connections used by the tour with the routed ones.
+        :param tour: list of nodes in the order of the tour
+        :return: True, if at least one connection was refined
+        """
+        refined = False
+        for node_i, node_j in zip(tour, tour[1:]):
+            point_i = self.checkpoints[node_i]
+            point_j = self.checkpoints[node_j]
+            if (point_i, point_j) not in self.estimated:
+                continue
+            self.distances[self.positions[node_i], self.positions[node_j]] = self.routing_service.cache_or_connection(
+                point_i[0], point_i[1], point_j[0], point_j[1]).get_cost()
+            self.estimated.remove((point_i, point_j))
+            refined = True
+        return refined
+
+    @metrics.timed('tsp.solve')
+    def solve(self, refine=True):
+        """
+        Solve the TSP and route estimated connections of the resulting tour, until the tour only uses routed
+        connections. Since the estimates are lower bounds, this tour is optimal for the fully routed matrix.
+        :param refine: if False, the first tour is returned, even if it uses estimated connections
+        """
+        if refine and self.estimated and not self.routing_service:
+            raise ValueError('A routing service is required to refine estimated connections.')
+        while True:
+            tour_with_costs, cost = self._solve_model()
+            if not refine or not self.refine(self.rearranged_tour):
+                return tour_with_costs, cost
+
+    def _add_visit_constraints(self, m, x):
+        """
+        Add the constraints, which nodes have to be visited. The variables are indexed by the positions of the nodes.
+        :return: the number of nodes of a complete tour
+        """
+        import gurobipy as gp
+
+        positions = range(len(self.nodes))
+        # Create degree 2 constraints
+        for i in positions:
+            m.addConstr(gp.quicksum(x[i, j]
+                        for j in positions if i != j) == 1)
+            m.addConstr(gp.quicksum(x[j, i]
+                        for j in positions if i != j) == 1)
+            m.addConstr(x[i, i] == 0)
+        return len(self.nodes)
+
+    def _solve_model(self):
         """
         Solve a dense asymmetric TSP using the following base formulation:
 
@@ -157,35 +239,29 @@ class TspSolver:
 
         and subtours eliminated using lazy constraints.
         """
+        import gurobipy as gp
 
         with gp.Env() as env, gp.Model(env=env) as m:
             # Optimize model using lazy constraints to eliminate subtours
             m.Params.LogToConsole = False
             m.Params.LogFile = "gurobi.log"
             m.Params.LazyConstraints = 1
-            m.Params.Threads = 1
-            # Create variables
-            x = m.addVars(self.distances.keys(), obj=self.distances,
-                          vtype=GRB.BINARY, name="e")
+            m.Params.Threads = self.threads
+            # Create variables for the positions in the distance matrix
+            x = m.addVars(len(self.nodes), len(self.nodes), obj=self.distances.ravel().tolist(),
+                          vtype=gp.GRB.BINARY, name="e")
 
             # Ensure that Bern is final destination
-            m.addConstr(x[self.index_of_final_destination,
-                        INDEX_OF_ARTIFICAL_NODE] == 1)
-
-            # Create degree 2 constraints
-            for i in self.nodes:
-                m.addConstr(gp.quicksum(x[i, j]
-                            for j in self.nodes if i != j) == 1)
-                m.addConstr(gp.quicksum(x[j, i]
-                            for j in self.nodes if i != j) == 1)
-                if (i, i) in self.distances:
-                    m.addConstr(x[i, i] == 0)
-            cb = self._tspCallback(self.nodes, x)
+            m.addConstr(x[self.positions[self.index_of_final_destination],
+                        POSITION_OF_ARTIFICAL_NODE] == 1)
+
+            visited = self._add_visit_constraints(m, x)
+            cb = self._tspCallback(range(len(self.nodes)), x, visited)
             m.optimize(cb)
 
             # Extract the solution as a tour
             edges = [(i, j) for (i, j), v in x.items() if v.X > 0.5]
-            tour = cb.shortest_subtour(edges)
+            tour = [self.nodes[position] for position in cb.shortest_subtour(edges)]
             # Find the index of INDEX_OF_ARTIFICAL_NODE
             depot_index = tour.index(INDEX_OF_ARTIFICAL_NODE)
 
@@ -196,11 +272,11 @@ class TspSolver:
                 rearranged_tour = rearranged_tour[::-1]
 
             # Calculate the cost of the tour starting with duration to the first checkpoint from the nearest station
-            cost = self.cost[rearranged_tour[0]]
+            cost = self.cost[self.positions[rearranged_tour[0]]]
             tour_with_costs = {rearranged_tour[0]: cost}
             for i in range(len(rearranged_tour)-1):
-                cost += self.distances[rearranged_tour[i],
-                                       rearranged_tour[i+1]]
+                cost += self.distances[self.positions[rearranged_tour[i]],
+                                       self.positions[rearranged_tour[i+1]]]
                 key = rearranged_tour[i+1]
                 tour_with_costs[key] = cost
 
@@ -212,14 +288,131 @@ class TspSolver:
             return tour_with_costs, m.ObjVal
 
 
-if __name__ == "__main__":
-    data = pd.read_csv('checkpoints.csv', sep=';', encoding='utf-8')
-
-    cache = Cache('.such_route_cache', "valhalla")
-    cache.load()
+def order_checkpoints(data, tour):
+    """
+    Add the position in the tour and the time to reach each checkpoint.
+    :param data: the checkpoints of the tour
+    :param tour: dict of the nodes in the order of the tour to the time to reach them
+    """
+    data['Order'] = sorted(
+        range(len(tour)), key=lambda x: list(tour.keys())[x])
+    data['Time'] = [tour[i] for i in data.index]
+    return data
+
+
+class GroupTspSolver(TspSolver):
+    """
+    Generalized TSP on the matrix of all checkpoints: the model decides which checkpoint of every group is skipped
+    and the order of the remaining ones, instead of solving every variant separately.
+    """
+    def __init__(self, cache, stations, data, importedDistance, cantons=None, **kwargs):
+        """
+        :param data: all checkpoints including their group
+        :param importedDistance: distance matrix between all checkpoints
+        :param cantons: dict of canton codes to Canton. If given, a connection can only be used, if its route does
+        not enter the canton of a skipped checkpoint
+        """
+        super().__init__(cache, stations, data, importedDistance, **kwargs)
+        self.canton_by_code = cantons
+        self.groups = defaultdict(list)
+        for node in self.checkpoints:
+            self.groups[int(data.loc[node, 'Group'])].append(node)
+        self.route_crossings = {}
+        if cantons:
+            for node_i in self.checkpoints:
+                for node_j in self.checkpoints:
+                    point_i = self.checkpoints[node_i]
+                    point_j = self.checkpoints[node_j]
+                    if node_i != node_j and (point_i, point_j) not in self.estimated:
+                        self._determine_route_crossings(node_i, node_j)
+        self.skipped = None
+
+    def _determine_route_crossings(self, node_i, node_j):
+        """
+        Determine the optional checkpoints, whose canton is entered by the route between two checkpoints.
+        """
+        point_i = self.checkpoints[node_i]
+        point_j = self.checkpoints[node_j]
+        route_key = self.cache.get_route_key(point_i, point_j)
+        # the coarse route decides, unless it is close to a border
+        route = self.cache.get_route_file(route_key, COARSE_LEVEL)
+        if route is None:
+            from routing_service import UNREACHABLE
+
+            # unreachable connections have no route, but can not be used anyway
+            if self.distances[self.positions[node_i], self.positions[node_j]] >= UNREACHABLE:
+                return
+            if not self.routing_service:
+                raise ValueError(f'The route from {point_i} to {point_j} is missing, a routing service is required '
+                                 f'to route it again.')
+            cost = self.routing_service.reroute(point_i[0], point_i[1], point_j[0], point_j[1]).get_cost()
+            self.distances[self.positions[node_i], self.positions[node_j]] = cost
+            route = self.cache.get_route_file(route_key, COARSE_LEVEL)
+            if route is None:
+                return
+        full_route = functools.cache(lambda: self.cache.get_file(route_key))
+        codes = {self.data.loc[node_i, 'Code'], self.data.loc[node_j, 'Code']}
+        self.route_crossings[node_i, node_j] = [
+            node for group, members in self.groups.items() if group not in MANDATORY_GROUPS for node in members
+            if self.data.loc[node, 'Code'] not in codes
+            and self.canton_by_code[self.data.loc[node, 'Code']].intersect(
+                route, ROUTE_TOLERANCES[COARSE_LEVEL], full_route)]
+
+    def refine(self, tour):
+        refined_connections = [(node_i, node_j) for node_i, node_j in zip(tour, tour[1:])
+                               if (self.checkpoints[node_i], self.checkpoints[node_j]) in self.estimated]
+        refined = super().refine(tour)
+        if self.canton_by_code:
+            for node_i, node_j in refined_connections:
+                self._determine_route_crossings(node_i, node_j)
+        return refined
+
+    def _add_visit_constraints(self, m, x):
+        """
+        Every checkpoint of a mandatory group is visited, all but one checkpoint of every other group are visited.
+        A connection entering the canton of a skipped checkpoint can not be used.
+        :return: the number of nodes of a complete tour
+        """
+        import gurobipy as gp
+
+        positions = range(len(self.nodes))
+        y = m.addVars(len(self.nodes), vtype=gp.GRB.BINARY, name="v")
+        for i in positions:
+            m.addConstr(gp.quicksum(x[i, j]
+                        for j in positions if i != j) == y[i])
+            m.addConstr(gp.quicksum(x[j, i]
+                        for j in positions if i != j) == y[i])
+            m.addConstr(x[i, i] == 0)
+        m.addConstr(y[POSITION_OF_ARTIFICAL_NODE] == 1)
+
+        visited = 1
+        for group, members in self.groups.items():
+            if group in MANDATORY_GROUPS:
+                m.addConstrs(y[self.positions[node]] == 1 for node in members)
+                visited += len(members)
+            else:
+                m.addConstr(gp.quicksum(y[self.positions[node]] for node in members) == len(members) - 1)
+                visited += len(members) - 1
+
+        for (i, j), crossed in self.route_crossings.items():
+            m.addConstrs(x[self.positions[i], self.positions[j]] <= y[self.positions[node]] for node in crossed)
+
+        return visited
+
+    def _solve_model(self):
+        tour_with_costs, cost = super()._solve_model()
+        self.skipped = [node for node in self.checkpoints if node not in tour_with_costs]
+        return tour_with_costs, cost
+
+
+def load_stations(cache, data):
+    """
+    Find the nearest station of every checkpoint, unless the station is given in the data.
+    :return: dict of (lat, lon) of the checkpoint to its NearestStation
+    """
+    from data.station import NearestStation
 
     stations = {}
-
     for index, row in data.iterrows():
         station_position = None
         checkpoint_position = (row['Latitude'], row['Longitude'])
@@ -227,35 +420,239 @@ if __name__ == "__main__":
                 row['Station_Lon']):
             station_position = (row['Station_Lat'], row['Station_Lon'])
         stations[checkpoint_position] = NearestStation(cache, checkpoint_position, station_position)
+    return stations
+
+
+def read_variant(directory, filename):
+    """
+    Read a distance matrix written by the sweep.
+    :return: the distance matrix, the estimated connections of a sparse matrix and the codes of the avoided cantons
+    """
+    with open(f"{directory}/" + filename, 'r') as f:
+        imported_distance = json.load(f)
+    estimated = None
+    codes = []
+    estimated_path = f"{directory}/" + json.estimated_filename(filename)
+    if os.path.exists(estimated_path):
+        with open(estimated_path, 'r') as estimated_file:
+            estimated = json.load_estimated(estimated_file)
+        match = re.match(r'distance_matrix-(.*)\.json$', filename)
+        codes = re.findall(r'CH-\w\w', match.group(1)) if match else []
+    return imported_distance, estimated, codes
+
+
+class VariantSolver:
+    """
+    Solves the TSP of the variant matrices with the checkpoints, stations and index shared by all variants.
+    """
+    def __init__(self, data, cache, stations, routing_backend=None, solver=None):
+        """
+        :param data: all checkpoints
+        :param routing_backend: class of the routing service to refine the estimated connections of sparse matrices
+        :param solver: class of the solver, TspSolver if None
+        """
+        self.data = data
+        self.cache = cache
+        self.stations = stations
+        self.index = CheckpointIndex(data, stations)
+        self.routing_backend = routing_backend or backends.load(VALHALLA)
+        self.solver = solver or TspSolver
+
+    def hash(self, imported_distance, estimated=None, codes=()):
+        station_costs = {coordinates: self.index.station_costs[self.index.rows[coordinates]]
+                         for coordinates in imported_distance if coordinates in self.index.rows}
+        return matrix_hash(imported_distance, station_costs, estimated, codes)
 
-    def solve_tsp(arguments):
-        directory, filename = arguments
-        with open(f"{directory}/" + filename, 'r') as f:
-            if not filename.endswith('json'):
-                return None, None
-            # Dictionary of Euclidean distance between each pair of points
-            imported_distance = json.load(f)
-            reduced_data = copy.copy(data)
-            for i, line in data.iterrows():
-                if (line['Longitude'], line['Latitude']) not in imported_distance:
-                    reduced_data.drop(index=i, inplace=True)
-
-            solver = TspSolver(cache, stations, reduced_data, imported_distance)
-            tour, cost = solver.solve()
-
-            reduced_data['Order'] = sorted(
-                range(len(tour)), key=lambda x: list(tour.keys())[x])
-            reduced_data['Time'] = [tour[i] for i in reduced_data.index]
-            return cost, reduced_data
-
-    results = []
-    for root, _, files in os.walk('results'):
-        with multiprocessing.Pool(multiprocessing.cpu_count() - 1) as p:
-            for (cost, result_data) in p.imap_unordered(solve_tsp, zip([root for _ in files], files)):
-                if cost and result_data is not None:
-                    results.append((cost, result_data))
-
-    results = sorted(results, key=lambda x: x[0])
-
-    results[0][1].to_csv('checkpoints_ordered.csv', sep=';', encoding='utf-8', index=False)
+    def fill_cached(self, imported_distance, estimated, nogos=None):
+        """
+        Replace the estimates of the connections, which are cached by now, e.g. routed to refine another variant.
+        :param nogos: the avoided cantons of the matrix
+        :return: tuple of the distance matrix and the remaining estimated connections, copies if any was replaced
+        """
+        cached_nogos = nogos if self.routing_backend.AVOIDS_NOGOS else None
+        cached = {(source, target): cache_hit[0] for source, target in estimated or ()
+                  if (cache_hit := self.cache.get(source, target, cached_nogos))}
+        if not cached:
+            return imported_distance, estimated
+        filled = {source: dict(costs) for source, costs in imported_distance.items()}
+        for (source, target), cost in cached.items():
+            filled[source][target] = cost
+        return filled, set(estimated) - cached.keys()
+
+    def refine(self, imported_distance, estimated, tour, nogos=None):
+        """
+        Route the estimated connections used by a tour, which was solved without refining it.
+        :param tour: list of (coordinates, time) in the order of the tour
+        :param nogos: the avoided cantons of the matrix
+        :return: tuple of the distance matrix and the remaining estimated connections to solve the variant again, None
+        if the tour only uses routed connections
+        """
+        used = [(source, target) for (source, _), (target, _) in zip(tour, tour[1:]) if (source, target) in estimated]
+        if not used:
+            return None
+        routing_service = self.routing_backend(self.cache, nogos=nogos)
+        for source, target in used:
+            routing_service.cache_or_connection(source[0], source[1], target[0], target[1])
+        return self.fill_cached(imported_distance, estimated, nogos)
+
+    def solve(self, imported_distance, estimated=None, codes=(), threads=1, refine=True):
+        """
+        :param codes: codes of the cantons avoided by the matrix, a sparse matrix is refined avoiding the same cantons
+        :param refine: if False, the estimated connections of the tour are not routed, see refine
+        :return: tuple of the cost and the list of (coordinates, time) in the order of the tour
+        """
+        reduced_data = self.data[self.data.index.isin(
+            [self.index.rows[coordinates] for coordinates in imported_distance
+             if coordinates in self.index.rows])].copy()
+        from data import Canton
+
+        routing_service = self.routing_backend(self.cache, nogos=[Canton(code, self.cache) for code in codes]) \
+            if estimated and refine else None
+
+        solver = self.solver(self.cache, self.stations, reduced_data, imported_distance,
+                             routing_service=routing_service, estimated=estimated, index=self.index, threads=threads)
+        tour, cost = solver.solve(refine)
+        # the tour is stored by coordinates, so it does not depend on the rows of checkpoints.csv
+        return float(cost), [(solver.checkpoints[node], float(time)) for node, time in tour.items()]
+
+    def order(self, tour):
+        """
+        :param tour: list of (coordinates, time) in the order of the tour
+        :return: the checkpoints of the tour with their order and time
+        """
+        tour = {self.index.rows[coordinates]: time for coordinates, time in tour}
+        return order_checkpoints(self.data.loc[sorted(tour)].copy(), tour)
+
+
+# the solver of a worker process
+_variant_solver: VariantSolver = None
+
+
+def init_worker(variant_solver):
+    """
+    Initializer of the worker processes of solve_variant and hash_variant.
+    """
+    global _variant_solver
+    _variant_solver = variant_solver
+    # the forked process inherits the metrics recorded so far, only its own ones are merged into the main process
+    metrics.reset()
+    # the copy of the cache is never saved, the connections routed to refine a tour are handed over to the main process
+    _variant_solver.cache.track_changes()
+
+
+def solve_variant(arguments, threads=1, refine=True):
+    """
+    Solve a variant in a worker process.
+    :param arguments: tuple of the key of the result, the distance matrix, the estimated connections and the codes of
+    the avoided cantons
+    :param refine: if False, the estimated connections of the tour are refined by the main process
+    :return: tuple of the key, the cost, the tour, the metrics of the worker process and the cache entries of the
+    connections routed to refine the tour
+    """
+    key, imported_distance, estimated, codes = arguments
+    cost, tour = _variant_solver.solve(imported_distance, estimated, codes, threads, refine)
+    # hand the metrics of the worker process over to the main process
+    snapshot = metrics.snapshot() if metrics.enabled else None
+    metrics.reset()
+    return key, cost, tour, snapshot, _variant_solver.cache.pop_changes()
+
+
+def solve_file(arguments, threads=1):
+    directory, (key, filename) = arguments
+    return solve_variant((key, *read_variant(directory, filename)), threads)
+
+
+def hash_variant(arguments):
+    directory, filename = arguments
+    imported_distance, estimated, codes = read_variant(directory, filename)
+    return filename, (_variant_solver.hash(imported_distance, estimated, codes), estimate_hardness(imported_distance))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Solves the TSP for every distance matrix in the results directory')
+    parser.add_argument('-m', '--metrics', type=str, default=None,
+                        help='Record timings of the hot paths and write them to the given JSON file')
+    parser.add_argument('-p', '--profile', type=str, default=None,
+                        help='Profile every phase with cProfile and write it to <PROFILE>-<phase>.prof')
+    parser.add_argument('-c', '--cpus', type=int, default=max(1, multiprocessing.cpu_count() - 1),
+                        help='Number of CPUs shared by the worker processes and the Gurobi threads')
+    parser.add_argument('-g', '--generalized', action='store_true',
+                        help='Solve a single model on results/distance_matrix.json, which decides the checkpoint to '
+                             'skip in every group')
+    args = parser.parse_args()
+
+    if args.metrics or args.profile:
+        metrics.enable(args.profile)
+
+    # pandas and shapely are only imported after the arguments are parsed, so --help starts fast
+    import pandas as pd
+    from data import Canton
+
+    data = pd.read_csv('checkpoints.csv', sep=';', encoding='utf-8')
+
+    cache = Cache('.such_route_cache', "valhalla")
+    cache.load()
 
+    with metrics.phase('stations'):
+        stations = load_stations(cache, data)
+
+    # shared by the solvers of all variants
+    variant_solver = VariantSolver(data, cache, stations)
+
+    def solve_generalized_tsp():
+        imported_distance, estimated, _ = read_variant('results', 'distance_matrix.json')
+        # routes estimated connections of the tour and connections, whose route file is missing
+        routing_service = backends.load(VALHALLA)(cache)
+        cantons = {code: Canton(code, cache) for code in data['Code']}
+
+        solver = GroupTspSolver(cache, stations, data, imported_distance, cantons=cantons,
+                                routing_service=routing_service, estimated=estimated, index=variant_solver.index,
+                                threads=args.cpus)
+        tour, cost = solver.solve()
+        print(f'skipped checkpoints: {", ".join(data.loc[solver.skipped, "Code"])}')
+        return cost, order_checkpoints(data.loc[sorted(tour)].copy(), tour)
+
+    if args.generalized:
+        with metrics.phase('solve'):
+            cost, result_data = solve_generalized_tsp()
+        # the connections routed to refine the tour
+        cache.save()
+    else:
+        # identical matrices of different variants are solved only once, solved tours are kept across runs
+        memo = TourMemo('.such_route_tours')
+        memo.load()
+        files = [filename for filename in sorted(os.listdir('results'))
+                 if filename.startswith('distance_matrix') and filename.endswith('.json')]
+        try:
+            with multiprocessing.Pool(args.cpus, initializer=init_worker, initargs=(variant_solver,)) as p:
+                with metrics.phase('hash'):
+                    hashes = dict(p.imap_unordered(hash_variant, [('results', filename) for filename in files],
+                                                   chunksize=16))
+                unsolved = {}
+                for filename, (key, hardness) in sorted(hashes.items()):
+                    if key not in memo:
+                        unsolved.setdefault(key, (hardness, filename))
+                hashes = {filename: key for filename, (key, _) in hashes.items()}
+                print(f'{len(hashes)} variants, {len(set(hashes.values()))} distinct matrices, '
+                      f'{len(unsolved)} to solve')
+                with metrics.phase('solve'):
+                    # the hardest matrices first, the last ones get the spare CPUs as additional Gurobi threads
+                    for key, cost, tour, snapshot, changes in Scheduler(p, args.cpus).run(
+                            solve_file, [(hardness, ('results', (key, filename)))
+                                         for key, (hardness, filename) in unsolved.items()]):
+                        if snapshot:
+                            metrics.merge(snapshot)
+                        cache.update(changes)
+                        memo.set(key, cost, tour)
+        finally:
+            memo.save()
+            # the connections routed by the workers
+            cache.save()
+
+        cost, tour = min((memo.get(key) for key in set(hashes.values())), key=lambda solved: solved[0])
+        result_data = variant_solver.order(tour)
+
+    result_data.to_csv('checkpoints_ordered.csv', sep=';', encoding='utf-8', index=False)
+
+    if args.metrics:
+        metrics.report(args.metrics)